@@ -1,5 +1,6 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta
 from app.database import get_db
 from app.schemas import UserCreate, UserLogin, Token, UserResponse
@@ -11,11 +12,11 @@ router = APIRouter(prefix="/auth", tags=["Authentication"])
 
 
 @router.post("/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-async def register(user_data: UserCreate, db: Session = Depends(get_db)):
+async def register(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
     """Register a new user"""
     # Check if user already exists
     from app.models.user import User
-    existing_user = db.query(User).filter(User.username == user_data.username).first()
+    existing_user = await db.scalar(select(User).filter(User.username == user_data.username))
     if existing_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -23,14 +24,14 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
         )
     
     # Create user
-    user = auth_service.create_user(db, user_data.username, user_data.password)
+    user = await auth_service.create_user(db, user_data.username, user_data.password)
     return user
 
 
 @router.post("/login", response_model=Token)
-async def login(user_data: UserLogin, db: Session = Depends(get_db)):
+async def login(user_data: UserLogin, db: AsyncSession = Depends(get_db)):
     """Login and get access token"""
-    user = auth_service.authenticate_user(db, user_data.username, user_data.password)
+    user = await auth_service.authenticate_user(db, user_data.username, user_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
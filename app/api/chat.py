@@ -1,36 +1,61 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
+import asyncio
+import base64
+import json
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Any, List, Optional, Tuple
 from app.database import get_db
 from app.api.dependencies import get_current_user
-from app.models.user import User
 from app.schemas import (
-    ChatMessage, ChatResponse, ChatHistoryResponse
+    ChatMessage, ChatResponse, ChatHistoryResponse, ChatSessionResponse, Principal
 )
 from app.services.ollama_service import ollama_service
 from app.services.database_service import db_service
+from app.services.context_builder import context_builder
+from app.services.history_writer import history_writer
+from app.services.user_context_cache import user_context_cache
+from app.services.timing import StageTimer, current_timer, stage_histograms
 from datetime import datetime
 
 router = APIRouter(prefix="/chat", tags=["Chat"])
 
 
+def _encode_cursor(timestamp: datetime, key: Any) -> str:
+    """Opaque pagination cursor for a (timestamp, key) sort position"""
+    raw = f"{timestamp.isoformat()}|{key}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip("=")
+
+
+def _decode_cursor(cursor: str, key_type: type = int) -> Tuple[datetime, Any]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode('utf-8')
+        timestamp, key = raw.split("|", 1)
+        return datetime.fromisoformat(timestamp), key_type(key)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+
 @router.post("/start", response_model=dict)
 async def start_chat(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
     """Start a new chat session and get greeting message"""
     # Create new session
     session_id = db_service.get_session_id()
     
     # Get user context for personalization
-    user_context = db_service.get_user_context(db, current_user.id)
+    user_context, _ = await user_context_cache.get(db, current_user.id)
     
     # Generate greeting message
-    greeting = ollama_service.create_greeting_message(user_context)
+    greeting = await ollama_service.create_greeting_message(user_context, user_id=current_user.id)
     
     # Save greeting to history
-    db_service.save_message(
+    await db_service.save_message(
         db=db,
         user_id=current_user.id,
         session_id=session_id,
@@ -49,69 +74,211 @@ async def start_chat(
 async def send_message(
     message_data: ChatMessage,
     session_id: str,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    response: Response,
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
     """Send a message in a chat session"""
-    # Save user message
-    db_service.save_message(
-        db=db,
-        user_id=current_user.id,
-        session_id=session_id,
-        role="user",
-        message=message_data.message
+    timer = StageTimer()
+    timer_token = current_timer.set(timer)
+    try:
+        # Get chat history within the token budget
+        with timer.stage("db_history"):
+            conversation = await context_builder.build(db, current_user.id, session_id)
+        
+        # Get user context for personalization
+        with timer.stage("db_user_context"):
+            user_context, user_context_str = await user_context_cache.get(db, current_user.id)
+            # Return the connection to the pool while the model is generating
+            await db.commit()
+        
+        # Get response from Ollama
+        with timer.stage("llm"):
+            try:
+                answer = await ollama_service.chat(
+                    message=message_data.message,
+                    chat_history=conversation["history"],
+                    user_context=user_context_str,
+                    user_id=current_user.id,
+                    session_id=session_id,
+                    history_summary=conversation["summary"],
+                    cache_opt_out=user_context.get("response_cache_opt_out", False)
+                )
+            except (Exception, asyncio.CancelledError):
+                await history_writer.save_unanswered(db, current_user.id, session_id, message_data.message)
+                raise
+        
+        # Save the turn
+        with timer.stage("db_save_turn"):
+            await history_writer.save_turn(
+                db,
+                user_id=current_user.id,
+                session_id=session_id,
+                user_message=message_data.message,
+                assistant_message=answer
+            )
+    finally:
+        current_timer.reset(timer_token)
+    
+    response.headers["Server-Timing"] = timer.server_timing_header()
+    stage_histograms.observe_timer("api_chat_message", timer)
+    
+    return ChatResponse(
+        role="assistant",
+        message=answer,
+        timestamp=datetime.utcnow()
     )
+
+
+@router.post("/message/stream")
+async def send_message_stream(
+    message_data: ChatMessage,
+    session_id: str,
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Send a message in a chat session and stream the response as Server-Sent Events"""
+    timer = StageTimer()
     
-    # Get chat history
-    history = db_service.get_session_history(db, current_user.id, session_id)
-    chat_history = [
-        {"role": msg.role, "message": msg.message}
-        for msg in history[:-1]  # Exclude the message we just saved
-    ]
+    # Get chat history within the token budget
+    with timer.stage("db_history"):
+        conversation = await context_builder.build(db, current_user.id, session_id)
     
     # Get user context for personalization
-    user_context_data = db_service.get_user_context(db, current_user.id)
-    user_context_str = ollama_service.create_personalized_context(user_context_data)
-    
-    # Get response from Ollama
-    response = await ollama_service.chat(
-        message=message_data.message,
-        chat_history=chat_history,
-        user_context=user_context_str
-    )
+    with timer.stage("db_user_context"):
+        user_context, user_context_str = await user_context_cache.get(db, current_user.id)
     
-    # Save assistant response
-    db_service.save_message(
-        db=db,
-        user_id=current_user.id,
-        session_id=session_id,
-        role="assistant",
-        message=response
-    )
+    user_id = current_user.id
     
-    return ChatResponse(
-        role="assistant",
-        message=response,
-        timestamp=datetime.utcnow()
+    # Saved before the stream starts, so the message is kept even if the
+    # client disconnects or the generation fails mid-stream
+    with timer.stage("db_save_message"):
+        await history_writer.save_message(db, user_id, session_id, "user", message_data.message)
+        # Return the connection to the pool while the model is generating
+        await db.commit()
+    
+    # Only the stages before the stream starts fit into the response header
+    server_timing = timer.server_timing_header()
+    
+    async def event_stream():
+        # The stream runs in its own task, so bind the timer there
+        current_timer.set(timer)
+        tokens = []
+        with timer.stage("llm"):
+            async for token in ollama_service.chat_stream(
+                message=message_data.message,
+                chat_history=conversation["history"],
+                user_context=user_context_str,
+                user_id=user_id,
+                session_id=session_id,
+                history_summary=conversation["summary"],
+                cache_opt_out=user_context.get("response_cache_opt_out", False)
+            ):
+                tokens.append(token)
+                yield f"data: {json.dumps({'token': token}, ensure_ascii=False)}\n\n"
+        
+        answer = "".join(tokens)
+        
+        # Save the reply once the stream is complete
+        with timer.stage("db_save_reply"):
+            await history_writer.save_message(db, user_id, session_id, "assistant", answer)
+        stage_histograms.observe_timer("api_chat_message_stream", timer)
+        
+        done = ChatResponse(
+            role="assistant",
+            message=answer,
+            timestamp=datetime.utcnow()
+        )
+        yield f"event: done\ndata: {done.model_dump_json()}\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "Server-Timing": server_timing
+        }
     )
 
 
 @router.get("/history/{session_id}", response_model=List[ChatHistoryResponse])
 async def get_chat_history(
     session_id: str,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    response: Response,
+    limit: int = Query(50, ge=1, le=200),
+    after: Optional[str] = Query(None, description="Cursor: return messages after it"),
+    before: Optional[str] = Query(None, description="Cursor: return messages before it"),
+    newest: bool = Query(False, description="Return the latest messages of the session"),
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
-    """Get chat history for a session"""
-    history = db_service.get_session_history(db, current_user.id, session_id)
+    """
+    Get a page of chat history for a session (oldest first)
+    
+    Cursors of the neighbouring pages are returned in the X-Prev-Cursor
+    and X-Next-Cursor headers.
+    """
+    if after and before:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Use either 'after' or 'before'"
+        )
+    
+    # Buffered turns of the session get ids only once they are written
+    await history_writer.ensure_flushed(session_id)
+    
+    # One extra row tells whether there is another page in the paging direction
+    history = await db_service.get_session_history(
+        db,
+        current_user.id,
+        session_id,
+        limit=limit + 1,
+        after=_decode_cursor(after) if after else None,
+        before=_decode_cursor(before) if before else None,
+        newest=newest
+    )
+    
+    backward = before is not None or newest
+    has_more = len(history) > limit
+    if has_more:
+        history = history[1:] if backward else history[:limit]
+    
+    if history:
+        has_prev = has_more if backward else after is not None
+        has_next = before is not None if backward else has_more
+        if has_prev:
+            response.headers["X-Prev-Cursor"] = _encode_cursor(history[0].created_at, history[0].id)
+        if has_next:
+            response.headers["X-Next-Cursor"] = _encode_cursor(history[-1].created_at, history[-1].id)
+    
     return history
 
 
-@router.get("/sessions", response_model=List[str])
+@router.get("/sessions", response_model=List[ChatSessionResponse])
 async def get_sessions(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    response: Response,
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[str] = Query(None, description="Cursor: return sessions after this one in the list"),
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
-    """Get all session IDs for current user"""
-    sessions = db_service.get_user_sessions(db, current_user.id)
+    """
+    Get sessions of the current user, most recently active first
+    
+    The cursor of the next page is returned in the X-Next-Cursor header.
+    """
+    await history_writer.ensure_flushed(user_id=current_user.id)
+    sessions = await db_service.get_user_sessions(
+        db,
+        current_user.id,
+        limit=limit + 1,
+        before=_decode_cursor(before, key_type=str) if before else None
+    )
+    
+    if len(sessions) > limit:
+        sessions = sessions[:limit]
+        last = sessions[-1]
+        response.headers["X-Next-Cursor"] = _encode_cursor(last.last_message_at, last.session_id)
+    
     return sessions
@@ -1,18 +1,18 @@
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.database import get_db
 from app.services.auth_service import auth_service
-from app.models.user import User
+from app.schemas import Principal
 
 security = HTTPBearer()
 
 
 async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
-) -> User:
-    """Get current authenticated user"""
+    db: AsyncSession = Depends(get_db)
+) -> Principal:
+    """Get current authenticated user (cached briefly per token)"""
     token = credentials.credentials
     token_data = auth_service.verify_token(token)
     
@@ -23,12 +23,12 @@ async def get_current_user(
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    user = db.query(User).filter(User.id == token_data.user_id).first()
-    if user is None:
+    principal = await auth_service.get_principal(db, token_data)
+    if principal is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not found",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    return user
+    return principal
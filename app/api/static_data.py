@@ -1,5 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
 from app.database import get_db
 from app.services.database_service import db_service
@@ -38,21 +38,21 @@ class StaticDataResponse(BaseModel):
 
 
 @router.get("/ai-behavior", response_model=List[str])
-async def get_ai_behavior_rules(db: Session = Depends(get_db)):
+async def get_ai_behavior_rules(db: AsyncSession = Depends(get_db)):
     """Get all active AI behavior rules"""
-    return db_service.get_ai_behavior_rules(db)
+    return await db_service.get_ai_behavior_rules(db)
 
 
 @router.get("/{category}", response_model=List[StaticDataResponse])
-async def get_static_data_by_category(category: str, db: Session = Depends(get_db)):
+async def get_static_data_by_category(category: str, db: AsyncSession = Depends(get_db)):
     """Get all static data by category"""
-    return db_service.get_static_data(db, category)
+    return await db_service.get_static_data(db, category)
 
 
 @router.post("/", response_model=StaticDataResponse)
-async def create_static_data(data: StaticDataCreate, db: Session = Depends(get_db)):
+async def create_static_data(data: StaticDataCreate, db: AsyncSession = Depends(get_db)):
     """Create new static data rule"""
-    rule = db_service.add_static_data(
+    rule = await db_service.add_static_data(
         db,
         category=data.category,
         key=data.key,
@@ -63,7 +63,7 @@ async def create_static_data(data: StaticDataCreate, db: Session = Depends(get_d
     
     # Reload AI rules cache if it's an AI behavior rule
     if data.category == 'ai_behavior':
-        ollama_service.reload_ai_rules()
+        await ollama_service.reload_ai_rules()
     
     return rule
 
@@ -72,10 +72,10 @@ async def create_static_data(data: StaticDataCreate, db: Session = Depends(get_d
 async def update_static_data(
     rule_id: int,
     data: StaticDataUpdate,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Update existing static data rule"""
-    rule = db_service.update_static_data(
+    rule = await db_service.update_static_data(
         db,
         rule_id=rule_id,
         value=data.value,
@@ -88,7 +88,7 @@ async def update_static_data(
     
     # Reload AI rules cache if it's an AI behavior rule
     if rule.category == 'ai_behavior':
-        ollama_service.reload_ai_rules()
+        await ollama_service.reload_ai_rules()
     
     return rule
 
@@ -96,7 +96,7 @@ async def update_static_data(
 @router.post("/reload-ai-rules")
 async def reload_ai_rules():
     """Force reload AI behavior rules from database"""
-    rules = ollama_service.reload_ai_rules()
+    rules = await ollama_service.reload_ai_rules()
     return {
         "message": "AI rules reloaded successfully",
         "rules_count": len(rules)
@@ -1,5 +1,6 @@
 from pydantic_settings import BaseSettings
 from functools import lru_cache
+from typing import List
 
 
 class Settings(BaseSettings):
@@ -9,10 +10,48 @@ class Settings(BaseSettings):
     DB_NAME: str
     DB_USER: str
     DB_PASSWORD: str
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
     
     # Ollama
     OLLAMA_MODEL: str
     OLLAMA_BASE_URL: str
+    OLLAMA_BASE_URLS: str = ""  # Comma-separated list of Ollama hosts (overrides OLLAMA_BASE_URL)
+    OLLAMA_MAX_CONCURRENCY: int = 4  # Concurrent generations admitted by the scheduler (across all hosts)
+    OLLAMA_FAILURE_THRESHOLD: int = 3  # Consecutive failures before a host is ejected
+    OLLAMA_RECOVERY_SECONDS: int = 30  # How long an ejected host stays out of rotation
+    OLLAMA_CONTEXT_REUSE: bool = False  # Keep per-session generation context instead of resending history
+    OLLAMA_CONTEXT_MAX_SESSIONS: int = 1000
+    OLLAMA_CONTEXT_TTL_SECONDS: int = 3600
+    OLLAMA_CONTEXT_MAX_TOKENS: int = 6144  # Drop the stored context once it grows past this
+    
+    # Response cache
+    RESPONSE_CACHE_ENABLED: bool = False
+    RESPONSE_CACHE_MAX_ENTRIES: int = 1000
+    RESPONSE_CACHE_TTL_SECONDS: int = 86400
+    RESPONSE_CACHE_SIMILARITY: float = 0.95  # Cosine similarity for a semantic hit
+    RESPONSE_CACHE_MIN_CHARS: int = 15  # Shorter messages are usually follow-ups and are not cached
+    OLLAMA_EMBED_MODEL: str = ""  # Embedding model for semantic matching (empty = exact match only)
+    
+    # Chat history window
+    HISTORY_TOKEN_BUDGET: int = 2000  # Approximate tokens of recent history sent to the model
+    HISTORY_MAX_MESSAGES: int = 100  # Upper bound on messages fetched for the window
+    HISTORY_SUMMARY_ENABLED: bool = True  # Fold older turns into a rolling summary
+    HISTORY_SUMMARY_BATCH: int = 50  # Messages folded into the summary per refresh
+    
+    # AI behavior rules
+    AI_RULES_POLL_SECONDS: int = 30  # Version check interval in case a change notification is missed, 0 disables
+    
+    # User personalization context cache
+    USER_CONTEXT_CACHE_SIZE: int = 10000
+    USER_CONTEXT_CACHE_TTL_SECONDS: int = 300  # Upper bound on staleness if an invalidation is missed
+    
+    # Chat history write-behind
+    HISTORY_WRITE_BEHIND: bool = False  # Buffer chat turns in memory and write them in bulk
+    HISTORY_FLUSH_INTERVAL_MS: int = 200
+    HISTORY_FLUSH_BATCH_ROWS: int = 500  # Rows per bulk write; reaching it triggers an early flush
+    HISTORY_BUFFER_MAX_ROWS: int = 10000  # Producers wait for a flush when the buffer is full
+    HISTORY_ENQUEUE_TIMEOUT_MS: int = 5000  # After waiting this long for space, a producer writes its rows directly
     
     # Application
     SECRET_KEY: str
@@ -24,6 +63,11 @@ class Settings(BaseSettings):
     JWT_SECRET_KEY: str
     JWT_ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60
+    BCRYPT_ROUNDS: int = 12  # Cost factor of new hashes; older hashes are upgraded on login
+    PASSWORD_HASH_WORKERS: int = 2  # Threads hashing passwords off the event loop
+    AUTH_PRINCIPAL_CACHE_SIZE: int = 10000
+    AUTH_PRINCIPAL_CACHE_TTL_SECONDS: int = 60  # How long a token is trusted without looking up its user
+    AUTH_TRUST_JWT_CLAIMS: bool = False  # Never look up the user; deleted users keep access until their token expires
     
     # Language
     DEFAULT_LANGUAGE: str = "russian"
@@ -31,15 +75,42 @@ class Settings(BaseSettings):
     # Telegram Bot (optional - only needed for Telegram bot)
     TELEGRAM_BOT_TOKEN: str = ""
     TELEGRAM_ADMIN_IDS: str = ""  # Comma-separated list of admin Telegram IDs
+    TELEGRAM_METRICS_PORT: int = 9101  # Prometheus metrics listener of the bot process, 0 disables
+    TELEGRAM_USER_CACHE_SIZE: int = 10000  # telegram_id -> user_id entries kept in memory
+    TELEGRAM_WORKERS: int = 16  # Chats handled concurrently; updates of one chat are handled in order
+    TELEGRAM_COALESCE_WINDOW_MS: int = 1000  # Quiet time that ends a burst of messages merged into one turn, 0 merges only queued ones
+    TELEGRAM_COALESCE_MAX_MESSAGES: int = 10  # Messages merged into one turn at most, 1 disables merging
+    TELEGRAM_STATE_CACHE_SIZE: int = 10000  # Active sessions and FSM states kept in memory (each)
+    TELEGRAM_STATE_CACHE_TTL_SECONDS: int = 300  # Upper bound for reading a stale entry if a notification is lost
+    TELEGRAM_WEBHOOK_ENABLED: bool = False  # Receive updates through a webhook instead of long polling
+    TELEGRAM_WEBHOOK_URL: str = ""  # Public base URL registered with Telegram; empty skips setWebhook (local testing)
+    TELEGRAM_WEBHOOK_PATH: str = "/telegram/webhook"
+    TELEGRAM_WEBHOOK_SECRET: str = ""  # Expected X-Telegram-Bot-Api-Secret-Token header; required with TELEGRAM_WEBHOOK_URL
+    TELEGRAM_WEBHOOK_HOST: str = "0.0.0.0"
+    TELEGRAM_WEBHOOK_PORT: int = 8081
+    TELEGRAM_WEBHOOK_SHUTDOWN_TIMEOUT: float = 30.0  # Seconds to finish updates in progress on shutdown
     
     # Google Search (optional - for web search functionality)
     GOOGLE_SEARCH_ENABLED: bool = True
     GOOGLE_MAX_RESULTS: int = 5
     
+    @property
+    def ollama_backends(self) -> List[str]:
+        hosts = [h.strip() for h in self.OLLAMA_BASE_URLS.split(",") if h.strip()]
+        return hosts or [self.OLLAMA_BASE_URL]
+    
+    @property
+    def telegram_webhook_url(self) -> str:
+        return self.TELEGRAM_WEBHOOK_URL.rstrip("/") + self.TELEGRAM_WEBHOOK_PATH
+    
     @property
     def database_url(self) -> str:
         return f"postgresql://{self.DB_USER}:{self.DB_PASSWORD}@{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}"
     
+    @property
+    def async_database_url(self) -> str:
+        return f"postgresql+asyncpg://{self.DB_USER}:{self.DB_PASSWORD}@{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}"
+    
     class Config:
         env_file = ".env"
 
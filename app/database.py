@@ -1,28 +1,66 @@
+import time
 from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from app.config import get_settings
 
 settings = get_settings()
 
-engine = create_engine(settings.database_url)
+
+class CheckoutWaitMixin:
+    """Reports how long callers wait for a connection from the pool"""
+    
+    def _do_get(self):
+        from app.services.metrics import DB_CHECKOUT_WAIT
+        started = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            DB_CHECKOUT_WAIT.observe(time.monotonic() - started)
+
+
+class InstrumentedQueuePool(CheckoutWaitMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncQueuePool(CheckoutWaitMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+# Sync engine for table creation and scripts
+engine = create_engine(settings.database_url, poolclass=InstrumentedQueuePool)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine used by the API and the Telegram bot
+async_engine = create_async_engine(
+    settings.async_database_url,
+    poolclass=InstrumentedAsyncQueuePool,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 
-def get_db():
+async def get_db():
     """Database dependency for FastAPI"""
-    db = SessionLocal()
-    try:
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 def init_db():
     """Initialize database tables"""
     # Import models here to register them with Base
-    from app.models.user import User, UserDetails, PersonalFact, ChatHistory
+    from app.models.user import (
+        User, UserDetails, PersonalFact, ChatHistory, ChatSession, StaticData, StaticDataVersion,
+        SessionSummary, TelegramSession, TelegramFSMState
+    )
     
     Base.metadata.create_all(bind=engine)
+    
+    # Bring tables created by older versions up to date
+    from app.migrations import run_migrations
+    run_migrations(engine)
@@ -1,9 +1,17 @@
-from fastapi import FastAPI
+import time
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from app.config import get_settings
 from app.database import init_db
 from app.api import auth, chat, user, static_data
 from app.services.ollama_service import ollama_service
+from app.services.history_writer import history_writer
+from app.services.user_context_cache import user_context_cache
+from app.services.notifications import notification_listener
+from app.services.auth_service import auth_service
+from app.services.timing import stage_histograms
+from app.services.metrics import HTTP_REQUESTS, HTTP_LATENCY
 
 settings = get_settings()
 
@@ -20,8 +28,27 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Prev-Cursor", "X-Next-Cursor"],
 )
 
+
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    """Count requests and measure latency per route"""
+    started = time.monotonic()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        # Use the route template so path parameters don't explode label cardinality
+        route = request.scope.get("route")
+        route_path = route.path if route is not None else "unmatched"
+        HTTP_REQUESTS.labels(request.method, route_path, str(status_code)).inc()
+        HTTP_LATENCY.labels(request.method, route_path).observe(time.monotonic() - started)
+
+
 # Include routers
 app.include_router(auth.router)
 app.include_router(chat.router)
@@ -42,6 +69,10 @@ async def startup_event():
         print("You can start PostgreSQL with: sudo systemctl start postgresql")
         raise
     
+    # Follow profile and AI rules changes made by other workers and the bot
+    await user_context_cache.start()
+    await ollama_service.ai_rules.start()
+    
     print("Checking Ollama service...")
     ollama_healthy = await ollama_service.health_check()
     if not ollama_healthy:
@@ -55,6 +86,14 @@ async def startup_event():
             print(f"WARNING: Model {settings.OLLAMA_MODEL} not found. Please pull it first.")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Write chat history still buffered in memory and stop background listeners"""
+    await history_writer.stop()
+    await ollama_service.ai_rules.stop()
+    await notification_listener.stop()
+
+
 @app.get("/")
 async def root():
     """Root endpoint"""
@@ -73,10 +112,30 @@ async def health_check():
     return {
         "status": "healthy",
         "database": "connected",
-        "ollama": "connected" if ollama_status else "disconnected"
+        "ollama": "connected" if ollama_status else "disconnected",
+        "ollama_backends": ollama_service.pool.get_status(),
+        "scheduler": ollama_service.scheduler.get_stats(),
+        "context_reuse": ollama_service.session_contexts.get_stats(),
+        "response_cache": ollama_service.response_cache.get_stats(),
+        "history_writer": history_writer.get_stats(),
+        "user_context_cache": user_context_cache.get_stats(),
+        "ai_rules": ollama_service.ai_rules.get_stats(),
+        "principal_cache": auth_service.principals.get_stats()
     }
 
 
+
+@app.get("/timings")
+async def get_timings():
+    """Aggregated per-stage latency histograms of chat turns"""
+    return stage_histograms.snapshot()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics exposition"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
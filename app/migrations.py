@@ -0,0 +1,163 @@
+"""
+Schema migrations for existing databases
+
+create_all() only creates missing tables. Columns, indexes and data
+changes for tables created by older versions are applied here. Every
+step (an SQL statement or a function of the connection) is idempotent,
+so the migrations simply run on each start.
+"""
+from typing import Callable, List, Tuple, Union
+import bcrypt
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+# Serializes concurrent starts of the API and the bot
+MIGRATION_LOCK_ID = 7301450021
+
+
+def convert_bot_accounts(conn: Connection):
+    """Mark accounts created by the bot as Telegram-only and drop their derived password"""
+    # A telegram id alone is no proof: migration users.telegram_id also takes it
+    # from personal facts, which any API user can write. Only the bot set the
+    # password telegram_<id>, so an account is converted only if its hash matches.
+    candidates = conn.execute(text("""
+        SELECT id, telegram_id, password_hash FROM users
+        WHERE telegram_id IS NOT NULL AND auth_type = 'password' AND password_hash IS NOT NULL
+    """)).all()
+    for user_id, telegram_id, password_hash in candidates:
+        try:
+            created_by_bot = bcrypt.checkpw(f"telegram_{telegram_id}".encode("utf-8"), password_hash.encode("utf-8"))
+        except ValueError:
+            created_by_bot = False
+        if created_by_bot:
+            conn.execute(
+                text("UPDATE users SET auth_type = 'telegram', password_hash = NULL WHERE id = :id"),
+                {"id": user_id}
+            )
+
+MIGRATIONS: List[Tuple[str, List[Union[str, Callable[[Connection], None]]]]] = [
+    (
+        "users.telegram_id",
+        [
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS telegram_id BIGINT",
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_telegram_id ON users (telegram_id)",
+            # Move telegram ids out of personal facts (earliest fact wins on duplicates)
+            """
+            UPDATE users SET telegram_id = facts.telegram_id
+            FROM (
+                SELECT DISTINCT ON (fact_value) user_id, fact_value::bigint AS telegram_id
+                FROM personal_facts
+                WHERE fact_key = 'telegram_id' AND fact_value ~ '^[0-9]{1,18}$'
+                ORDER BY fact_value, id
+            ) AS facts
+            WHERE users.id = facts.user_id
+              AND users.telegram_id IS NULL
+              AND NOT EXISTS (SELECT 1 FROM users other WHERE other.telegram_id = facts.telegram_id)
+            """,
+            """
+            DELETE FROM personal_facts
+            USING users
+            WHERE personal_facts.user_id = users.id
+              AND personal_facts.fact_key = 'telegram_id'
+              AND personal_facts.fact_value = users.telegram_id::text
+            """
+        ]
+    ),
+    (
+        "users.auth_type",
+        [
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS auth_type VARCHAR(20) NOT NULL DEFAULT 'password'",
+            "ALTER TABLE users ALTER COLUMN password_hash DROP NOT NULL",
+            # Bot users had a password derived from their telegram id; it was never meant for sign-in
+            convert_bot_accounts
+        ]
+    ),
+    (
+        "chat_history composite indexes",
+        [
+            "CREATE INDEX IF NOT EXISTS ix_chat_history_user_session_created "
+            "ON chat_history (user_id, session_id, created_at, id)",
+            "CREATE INDEX IF NOT EXISTS ix_chat_history_session_created "
+            "ON chat_history (session_id, created_at, id)",
+            # Covered by the prefix of ix_chat_history_session_created
+            "DROP INDEX IF EXISTS ix_chat_history_session_id"
+        ]
+    ),
+    (
+        "chat_sessions backfill",
+        [
+            # Only when the table was just created; afterwards it is maintained on write
+            """
+            INSERT INTO chat_sessions (session_id, user_id, title, message_count, created_at, last_message_at)
+            SELECT
+                history.session_id,
+                MIN(history.user_id),
+                (
+                    SELECT LEFT(first_message.message, 100)
+                    FROM chat_history first_message
+                    WHERE first_message.session_id = history.session_id AND first_message.role = 'user'
+                    ORDER BY first_message.created_at, first_message.id
+                    LIMIT 1
+                ),
+                COUNT(*) FILTER (WHERE history.role IN ('user', 'assistant')),
+                MIN(history.created_at),
+                MAX(history.created_at)
+            FROM chat_history history
+            WHERE NOT EXISTS (SELECT 1 FROM chat_sessions)
+            GROUP BY history.session_id
+            ON CONFLICT (session_id) DO NOTHING
+            """
+        ]
+    ),
+    (
+        "static_data change notifications",
+        [
+            # Every write to static_data, from any client, bumps the category version and
+            # notifies listening processes once the transaction commits
+            """
+            CREATE OR REPLACE FUNCTION static_data_bump_version() RETURNS trigger AS $$
+            DECLARE
+                changed_category VARCHAR(100);
+            BEGIN
+                FOR changed_category IN
+                    SELECT DISTINCT category FROM unnest(ARRAY[
+                        CASE WHEN TG_OP <> 'INSERT' THEN OLD.category END,
+                        CASE WHEN TG_OP <> 'DELETE' THEN NEW.category END
+                    ]) AS categories (category)
+                    WHERE category IS NOT NULL
+                LOOP
+                    INSERT INTO static_data_versions (category, version) VALUES (changed_category, 1)
+                    ON CONFLICT (category) DO UPDATE SET version = static_data_versions.version + 1;
+                    PERFORM pg_notify('static_data_changed', changed_category);
+                END LOOP;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "DROP TRIGGER IF EXISTS static_data_version ON static_data",
+            "CREATE TRIGGER static_data_version AFTER INSERT OR UPDATE OR DELETE ON static_data "
+            "FOR EACH ROW EXECUTE FUNCTION static_data_bump_version()"
+        ]
+    ),
+    (
+        "user_details.response_cache_opt_out",
+        [
+            "ALTER TABLE user_details ADD COLUMN IF NOT EXISTS response_cache_opt_out BOOLEAN NOT NULL DEFAULT FALSE"
+        ]
+    ),
+]
+
+
+def run_migrations(engine: Engine):
+    """Apply all migrations in one transaction (PostgreSQL only)"""
+    if engine.dialect.name != "postgresql":
+        return
+    
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        for name, statements in MIGRATIONS:
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(text(statement))
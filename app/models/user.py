@@ -1,10 +1,15 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, BigInteger, Boolean, String, DateTime, ForeignKey, Text, Index, JSON
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.database import Base
 import random
 
 
+# How a user signs in
+AUTH_TYPE_PASSWORD = "password"
+AUTH_TYPE_TELEGRAM = "telegram"  # Registered through the bot, has no password
+
+
 def generate_user_id():
     """Generate a 9-digit user ID"""
     user_id = random.randint(0, 999999999)
@@ -16,7 +21,9 @@ class User(Base):
     
     id = Column(String(9), primary_key=True, default=lambda: str(generate_user_id()))
     username = Column(String(100), unique=True, index=True, nullable=False)
-    password_hash = Column(String(255), nullable=False)
+    password_hash = Column(String(255))  # NULL for users without a password
+    auth_type = Column(String(20), nullable=False, default=AUTH_TYPE_PASSWORD, server_default=AUTH_TYPE_PASSWORD)
+    telegram_id = Column(BigInteger, unique=True, index=True)  # Set for users registered through the bot
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
@@ -35,6 +42,8 @@ class UserDetails(Base):
     email = Column(String(200))
     phone = Column(String(50))
     bio = Column(Text)
+    # Keep personalized answers out of the shared response cache
+    response_cache_opt_out = Column(Boolean, nullable=False, default=False, server_default="false")
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
@@ -58,10 +67,16 @@ class PersonalFact(Base):
 
 class ChatHistory(Base):
     __tablename__ = "chat_history"
+    __table_args__ = (
+        # Session history of a user in time order (also serves keyset pagination)
+        Index("ix_chat_history_user_session_created", "user_id", "session_id", "created_at", "id"),
+        # Latest messages of a session for the LLM context
+        Index("ix_chat_history_session_created", "session_id", "created_at", "id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(String(9), ForeignKey("users.id"), nullable=False)
-    session_id = Column(String(100), index=True, nullable=False)
+    session_id = Column(String(100), nullable=False)
     role = Column(String(50), nullable=False)  # 'user' or 'assistant'
     message = Column(Text, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -70,6 +85,33 @@ class ChatHistory(Base):
     user = relationship("User", back_populates="chat_history")
 
 
+class ChatSession(Base):
+    """Per-session metadata maintained on every saved message"""
+    __tablename__ = "chat_sessions"
+    __table_args__ = (
+        Index("ix_chat_sessions_user_last_message", "user_id", "last_message_at", "session_id"),
+    )
+    
+    session_id = Column(String(100), primary_key=True)
+    user_id = Column(String(9), ForeignKey("users.id"), nullable=False)
+    title = Column(String(200))  # Start of the first user message
+    message_count = Column(Integer, nullable=False, default=0)  # User and assistant messages
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    last_message_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class SessionSummary(Base):
+    """Rolling summary of the older part of a chat session"""
+    __tablename__ = "session_summaries"
+    
+    session_id = Column(String(100), primary_key=True)
+    user_id = Column(String(9), ForeignKey("users.id"), nullable=False)
+    summary = Column(Text, nullable=False)
+    summarized_until_id = Column(Integer, nullable=False)  # Last chat_history.id folded into the summary
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+
 class StaticData(Base):
     """Static configuration data for AI behavior and system rules"""
     __tablename__ = "static_data"
@@ -83,3 +125,30 @@ class StaticData(Base):
     priority = Column(Integer, default=0)  # Higher priority rules are applied first
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+
+class StaticDataVersion(Base):
+    """Change counter per static data category (bumped by a database trigger)"""
+    __tablename__ = "static_data_versions"
+    
+    category = Column(String(100), primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+
+
+class TelegramSession(Base):
+    """Active chat session of a Telegram user, shared by all bot processes"""
+    __tablename__ = "telegram_sessions"
+    
+    telegram_id = Column(BigInteger, primary_key=True)
+    session_id = Column(String(100), nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class TelegramFSMState(Base):
+    """aiogram FSM state and data of one chat/user key"""
+    __tablename__ = "telegram_fsm"
+    
+    key = Column(String(200), primary_key=True)  # bot:chat:user[:thread]:destiny
+    state = Column(String(200))
+    data = Column(JSON(none_as_null=True))  # NULL when empty
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
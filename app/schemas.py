@@ -31,6 +31,7 @@ class UserDetailsBase(BaseModel):
     email: Optional[str] = None
     phone: Optional[str] = None
     bio: Optional[str] = None
+    response_cache_opt_out: bool = False
 
 
 class UserDetailsCreate(UserDetailsBase):
@@ -95,6 +96,17 @@ class ChatHistoryResponse(BaseModel):
         from_attributes = True
 
 
+class ChatSessionResponse(BaseModel):
+    session_id: str
+    title: Optional[str] = None
+    message_count: int
+    created_at: datetime
+    last_message_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+
 # Token Schemas
 class Token(BaseModel):
     access_token: str
@@ -104,3 +116,10 @@ class Token(BaseModel):
 class TokenData(BaseModel):
     user_id: Optional[str] = None
     username: Optional[str] = None
+    expires_at: Optional[int] = None  # 'exp' claim, unix time
+
+
+class Principal(BaseModel):
+    """Authenticated user as seen by the API routes"""
+    id: str
+    username: Optional[str] = None
@@ -0,0 +1,129 @@
+import asyncio
+import contextvars
+import hashlib
+from typing import List, Dict, Any, Optional
+from app.database import AsyncSessionLocal
+from app.services.database_service import db_service
+from app.services.notifications import notification_listener
+
+CHANGE_CHANNEL = "static_data_changed"
+
+
+class AIRulesStore:
+    """
+    Versioned snapshot of the AI behavior rules
+    
+    The snapshot holds the rules, their pre-rendered system prompt block
+    and the version of the 'ai_behavior' category, which a database trigger
+    bumps on every change. Processes reload the snapshot when the trigger's
+    NOTIFY arrives and, in case a notification is missed, when a periodic
+    version check finds a newer version.
+    """
+    
+    CATEGORY = "ai_behavior"
+    
+    def __init__(self, poll_seconds: float):
+        self.poll_seconds = poll_seconds
+        self.snapshot: Optional[Dict[str, Any]] = None
+        self._changed = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "reloads": 0,
+            "version_checks": 0,
+            "notifications": 0
+        }
+    
+    @staticmethod
+    def render(rules: List[str]) -> str:
+        """Render the rules section of the system prompt"""
+        if not rules:
+            return ""
+        lines = ["ПРАВИЛА ПОВЕДЕНИЯ:"]
+        lines.extend(f"{i}. {rule}" for i, rule in enumerate(rules, 1))
+        lines.append("")  # Empty line
+        return "\n".join(lines)
+    
+    async def get(self) -> Dict[str, Any]:
+        """Get the current snapshot (loaded on first use)"""
+        if self.snapshot is None:
+            await self.reload()
+        return self.snapshot
+    
+    async def reload(self) -> Dict[str, Any]:
+        """Load the rules from the database"""
+        async with self._lock:
+            try:
+                async with AsyncSessionLocal() as db:
+                    # Version first: a change committed in between only causes another reload
+                    version = await db_service.get_static_data_version(db, self.CATEGORY)
+                    rules = await db_service.get_ai_behavior_rules(db)
+            except Exception as e:
+                print(f"Error loading AI rules: {e}")
+                if self.snapshot is None:
+                    # Serve without rules; the next version check retries
+                    self.snapshot = self._make_snapshot(-1, [])
+                return self.snapshot
+            
+            self.snapshot = self._make_snapshot(version, rules)
+            self.stats["reloads"] += 1
+            return self.snapshot
+    
+    async def refresh(self):
+        """Reload the rules if another process changed them"""
+        self.stats["version_checks"] += 1
+        async with AsyncSessionLocal() as db:
+            version = await db_service.get_static_data_version(db, self.CATEGORY)
+        if self.snapshot is None or self.snapshot["version"] != version:
+            await self.reload()
+    
+    async def start(self):
+        """Follow rule changes made by other processes"""
+        await notification_listener.subscribe(CHANGE_CHANNEL, self._on_notification, on_connect=self._changed.set)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), context=contextvars.Context())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=self.poll_seconds or None)
+            except asyncio.TimeoutError:
+                pass
+            self._changed.clear()
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Error checking AI rules version: {e}")
+    
+    def _on_notification(self, category: str):
+        if category == self.CATEGORY:
+            self.stats["notifications"] += 1
+            self._changed.set()
+    
+    @classmethod
+    def _make_snapshot(cls, version: int, rules: List[str]) -> Dict[str, Any]:
+        block = cls.render(rules)
+        return {
+            "version": version,
+            "rules": rules,
+            "block": block,
+            # Identifies the prompt content, e.g. for response cache keys
+            "fingerprint": hashlib.sha256(block.encode('utf-8')).hexdigest()[:16]
+        }
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "version": self.snapshot["version"] if self.snapshot else None,
+            "rules": len(self.snapshot["rules"]) if self.snapshot else 0,
+            "listening": notification_listener.connected,
+            **self.stats
+        }
@@ -1,16 +1,69 @@
+import asyncio
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Any, Optional, Tuple
 from jose import JWTError, jwt
 import bcrypt
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.config import get_settings
-from app.models.user import User
-from app.schemas import TokenData
+from app.models.user import User, AUTH_TYPE_PASSWORD
+from app.schemas import TokenData, Principal
 from app.services.base import BaseService
 
 settings = get_settings()
 
 
+class PrincipalCache:
+    """
+    Short-lived cache of authenticated principals keyed by (user id, token expiry)
+    
+    Saves the user lookup on every request. An entry lives at most
+    `ttl_seconds` and never past its token's expiry, which bounds how long
+    a removed user stays authenticated.
+    """
+    
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Tuple[str, Optional[int]], Dict[str, Any]]" = OrderedDict()
+        self.stats = {
+            "hits": 0,
+            "misses": 0
+        }
+    
+    def get(self, key: Tuple[str, Optional[int]]) -> Optional[Principal]:
+        entry = self._entries.get(key)
+        if entry is None or entry["expires"] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry["principal"]
+    
+    def put(self, key: Tuple[str, Optional[int]], principal: Principal):
+        ttl = self.ttl_seconds
+        token_expiry = key[1]
+        if token_expiry is not None:
+            ttl = min(ttl, token_expiry - time.time())
+        if ttl <= 0:
+            return
+        self._entries[key] = {"principal": principal, "expires": time.monotonic() + ttl}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            **self.stats
+        }
+
+
 class AuthService(BaseService):
     """Authentication and authorization service"""
     
@@ -18,6 +71,16 @@ class AuthService(BaseService):
         self.secret_key = settings.JWT_SECRET_KEY
         self.algorithm = settings.JWT_ALGORITHM
         self.access_token_expire_minutes = settings.ACCESS_TOKEN_EXPIRE_MINUTES
+        self.bcrypt_rounds = settings.BCRYPT_ROUNDS
+        # bcrypt releases the GIL, so a few threads keep hashing off the event loop
+        self._hash_executor = ThreadPoolExecutor(
+            max_workers=max(1, settings.PASSWORD_HASH_WORKERS),
+            thread_name_prefix="password-hash"
+        )
+        self.principals = PrincipalCache(
+            settings.AUTH_PRINCIPAL_CACHE_SIZE,
+            settings.AUTH_PRINCIPAL_CACHE_TTL_SECONDS
+        )
     
     async def initialize(self) -> bool:
         """Initialize auth service"""
@@ -27,18 +90,28 @@ class AuthService(BaseService):
         """Check auth service health"""
         return True
     
-    def verify_password(self, plain_password: str, hashed_password: str) -> bool:
-        """Verify a password against its hash"""
+    async def verify_password(self, plain_password: str, hashed_password: str) -> bool:
+        """Verify a password against its hash (in the hashing pool)"""
         password_bytes = plain_password.encode('utf-8')
         hashed_bytes = hashed_password.encode('utf-8')
-        return bcrypt.checkpw(password_bytes, hashed_bytes)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._hash_executor, bcrypt.checkpw, password_bytes, hashed_bytes)
     
-    def get_password_hash(self, password: str) -> str:
-        """Hash a password"""
+    async def get_password_hash(self, password: str) -> str:
+        """Hash a password with the configured cost factor (in the hashing pool)"""
         password_bytes = password.encode('utf-8')
-        hashed = bcrypt.hashpw(password_bytes, bcrypt.gensalt())
+        salt = bcrypt.gensalt(rounds=self.bcrypt_rounds)
+        loop = asyncio.get_running_loop()
+        hashed = await loop.run_in_executor(self._hash_executor, bcrypt.hashpw, password_bytes, salt)
         return hashed.decode('utf-8')
     
+    def needs_rehash(self, hashed_password: str) -> bool:
+        """Whether a hash was made with a different cost factor ($2b$<rounds>$...)"""
+        try:
+            return int(hashed_password.split('$')[2]) != self.bcrypt_rounds
+        except (IndexError, ValueError):
+            return False
+    
     def create_access_token(self, data: dict, expires_delta: Optional[timedelta] = None) -> str:
         """Create JWT access token"""
         to_encode = data.copy()
@@ -59,26 +132,50 @@ class AuthService(BaseService):
             username: str = payload.get("username")
             if user_id is None:
                 return None
-            return TokenData(user_id=user_id, username=username)
+            return TokenData(user_id=user_id, username=username, expires_at=payload.get("exp"))
         except JWTError:
             return None
     
-    def authenticate_user(self, db: Session, username: str, password: str) -> Optional[User]:
+    async def get_principal(self, db: AsyncSession, token_data: TokenData) -> Optional[Principal]:
+        """Resolve a verified token to its user (None if the user no longer exists)"""
+        if settings.AUTH_TRUST_JWT_CLAIMS:
+            return Principal(id=token_data.user_id, username=token_data.username)
+        
+        key = (token_data.user_id, token_data.expires_at)
+        principal = self.principals.get(key)
+        if principal is None:
+            user = await db.get(User, token_data.user_id)
+            if user is None:
+                return None
+            principal = Principal(id=user.id, username=user.username)
+            self.principals.put(key, principal)
+        return principal
+    
+    async def authenticate_user(self, db: AsyncSession, username: str, password: str) -> Optional[User]:
         """Authenticate a user"""
-        user = db.query(User).filter(User.username == username).first()
+        user = await db.scalar(select(User).filter(User.username == username))
         if not user:
             return None
-        if not self.verify_password(password, user.password_hash):
+        # Users registered through Telegram have no password
+        if user.auth_type != AUTH_TYPE_PASSWORD or not user.password_hash:
+            return None
+        # Return the connection to the pool while the password is being checked
+        await db.commit()
+        if not await self.verify_password(password, user.password_hash):
             return None
+        
+        if self.needs_rehash(user.password_hash):
+            user.password_hash = await self.get_password_hash(password)
+            await db.commit()
         return user
     
-    def create_user(self, db: Session, username: str, password: str) -> User:
+    async def create_user(self, db: AsyncSession, username: str, password: str) -> User:
         """Create a new user"""
-        hashed_password = self.get_password_hash(password)
-        user = User(username=username, password_hash=hashed_password)
+        hashed_password = await self.get_password_hash(password)
+        user = User(username=username, password_hash=hashed_password, auth_type=AUTH_TYPE_PASSWORD)
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        await db.refresh(user)
         return user
 
 
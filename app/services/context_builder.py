@@ -0,0 +1,137 @@
+import asyncio
+import contextvars
+from typing import Dict, Any, Set
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import get_settings
+from app.database import AsyncSessionLocal
+from app.services.database_service import db_service
+from app.services.history_writer import history_writer
+from app.services.ollama_service import ollama_service
+
+settings = get_settings()
+
+
+class ContextBuilder:
+    """
+    Builds the conversation context sent to the LLM
+    
+    History is taken newest-first until the token budget is used up, so the
+    model always sees the most recent turns. Turns that fall out of the
+    window are folded into a rolling per-session summary in the background.
+    """
+    
+    # Per-message overhead for role markers in the chat template
+    MESSAGE_OVERHEAD_TOKENS = 4
+    
+    def __init__(self):
+        self._refreshing: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+    
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """Rough token estimate (about 3 characters per token for mixed Cyrillic/Latin text)"""
+        return max(1, len(text) // 3)
+    
+    async def build(self, db: AsyncSession, user_id: str, session_id: str) -> Dict[str, Any]:
+        """
+        Select chat history within the token budget
+        
+        Args:
+            db: Database session
+            user_id: Owner of the session
+            session_id: Chat session
+        
+        Returns:
+            Dict with 'history' (oldest first, formatted for LLM) and
+            'summary' (summary of older turns or None)
+        """
+        recent = await db_service.get_recent_messages(
+            db, session_id, settings.HISTORY_MAX_MESSAGES, user_id=user_id
+        )
+        recent = history_writer.merge_recent(session_id, user_id, recent, settings.HISTORY_MAX_MESSAGES)
+        
+        budget = settings.HISTORY_TOKEN_BUDGET
+        window = []
+        used = 0
+        for msg in recent:
+            cost = self.estimate_tokens(msg.message) + self.MESSAGE_OVERHEAD_TOKENS
+            if window and used + cost > budget:
+                break
+            window.append(msg)
+            used += cost
+        
+        history = [
+            {"role": msg.role, "message": msg.message}
+            for msg in reversed(window)
+        ]
+        
+        if len(window) == len(recent) and len(recent) < settings.HISTORY_MAX_MESSAGES:
+            # The whole session fits into the budget
+            return {"history": history, "summary": None}
+        
+        summary = None
+        if settings.HISTORY_SUMMARY_ENABLED:
+            # Newest stored message that did not fit; everything up to it belongs in the summary.
+            # Messages still buffered by the history writer have no id yet.
+            if len(window) < len(recent):
+                last_excluded_id = next((msg.id for msg in recent[len(window):] if msg.id is not None), None)
+            else:
+                last_excluded_id = window[-1].id - 1 if window[-1].id is not None else None
+            
+            db_summary = await db_service.get_session_summary(db, session_id)
+            if db_summary:
+                summary = db_summary.summary
+            summarized_until_id = db_summary.summarized_until_id if db_summary else 0
+            
+            if last_excluded_id is not None and summarized_until_id < last_excluded_id:
+                self._schedule_refresh(user_id, session_id, last_excluded_id)
+        
+        return {"history": history, "summary": summary}
+    
+    def _schedule_refresh(self, user_id: str, session_id: str, until_id: int):
+        if session_id in self._refreshing:
+            return
+        self._refreshing.add(session_id)
+        # Run detached from the request context so its timings are not attributed to the request
+        task = asyncio.create_task(
+            self._refresh_summary(user_id, session_id, until_id),
+            context=contextvars.Context()
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _refresh_summary(self, user_id: str, session_id: str, until_id: int):
+        """Fold messages that left the history window into the session summary"""
+        try:
+            async with AsyncSessionLocal() as db:
+                db_summary = await db_service.get_session_summary(db, session_id)
+                previous_summary = db_summary.summary if db_summary else None
+                after_id = db_summary.summarized_until_id if db_summary else 0
+                
+                messages = await db_service.get_messages_for_summary(
+                    db, session_id, after_id, until_id, settings.HISTORY_SUMMARY_BATCH
+                )
+                if not messages:
+                    return
+                
+                # Release the connection while the model is summarizing
+                await db.close()
+                
+                summary = await ollama_service.summarize_history(
+                    previous_summary,
+                    [{"role": msg.role, "message": msg.message} for msg in messages],
+                    user_id=user_id
+                )
+                if not summary:
+                    return
+                
+                await db_service.save_session_summary(db, session_id, user_id, summary, messages[-1].id)
+        
+        except Exception as e:
+            print(f"Error refreshing session summary: {e}")
+        finally:
+            self._refreshing.discard(session_id)
+
+
+# Singleton instance
+context_builder = ContextBuilder()
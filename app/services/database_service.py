@@ -1,8 +1,13 @@
-from typing import List, Optional, Dict, Any
-from sqlalchemy.orm import Session
+from typing import List, Optional, Dict, Any, Tuple
+from sqlalchemy import select, delete, tuple_, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
 import uuid
-from app.models.user import User, UserDetails, PersonalFact, ChatHistory, StaticData
+from app.models.user import (
+    User, UserDetails, PersonalFact, ChatHistory, ChatSession, StaticData, StaticDataVersion,
+    SessionSummary, TelegramSession, TelegramFSMState, AUTH_TYPE_PASSWORD
+)
 from app.schemas import (
     UserDetailsCreate, UserDetailsUpdate,
     PersonalFactCreate, PersonalFactUpdate
@@ -22,177 +27,218 @@ class DatabaseService(BaseService):
         return True
     
     # User operations
-    def get_user_by_telegram_id(self, db: Session, telegram_id: int) -> Optional[User]:
-        """Get user by telegram_id from personal facts"""
-        fact = db.query(PersonalFact).filter(
-            PersonalFact.fact_key == "telegram_id",
-            PersonalFact.fact_value == str(telegram_id)
-        ).first()
-        
-        if fact:
-            return db.query(User).filter(User.id == fact.user_id).first()
-        return None
+    async def get_user_by_telegram_id(self, db: AsyncSession, telegram_id: int) -> Optional[User]:
+        """Get user by telegram_id"""
+        return await db.scalar(select(User).filter(User.telegram_id == telegram_id))
     
-    def create_user(self, db: Session, user_data: Dict[str, str]) -> Optional[User]:
-        """Create new user"""
-        import bcrypt
-        
-        # Hash password using bcrypt directly
-        password_bytes = user_data["password"].encode('utf-8')
-        hashed = bcrypt.hashpw(password_bytes, bcrypt.gensalt())
-        
+    async def get_user_id_by_telegram_id(self, db: AsyncSession, telegram_id: int) -> Optional[str]:
+        """Get only the user id by telegram_id"""
+        return await db.scalar(select(User.id).filter(User.telegram_id == telegram_id))
+    
+    async def get_user(self, db: AsyncSession, user_id: str) -> Optional[User]:
+        """Get user by id"""
+        return await db.get(User, user_id)
+    
+    async def get_user_by_username(self, db: AsyncSession, username: str) -> Optional[User]:
+        """Get user by username"""
+        return await db.scalar(select(User).filter(User.username == username))
+    
+    async def create_user(self, db: AsyncSession, user_data: Dict[str, Any]) -> Optional[User]:
+        """Create new user (passwords are hashed by auth_service, users without one get no hash)"""
         new_user = User(
             username=user_data["username"],
-            password_hash=hashed.decode('utf-8')
+            password_hash=user_data.get("password_hash"),
+            auth_type=user_data.get("auth_type", AUTH_TYPE_PASSWORD),
+            telegram_id=user_data.get("telegram_id")
         )
         
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        await db.commit()
+        await db.refresh(new_user)
         return new_user
     
-    def get_user_with_details(self, db: Session, user_id: str) -> Dict[str, Any]:
+    async def get_user_with_details(self, db: AsyncSession, user_id: str) -> Dict[str, Any]:
         """Get user with all details and facts"""
-        return self.get_user_context(db, user_id)
+        return await self.get_user_context(db, user_id)
     
-    def create_chat_session(self, db: Session, user_id: str) -> Optional[ChatHistory]:
+    async def create_chat_session(self, db: AsyncSession, user_id: str) -> Optional[ChatHistory]:
         """Create new chat session"""
         session_id = self.get_session_id()
         # Create initial message to mark session start
-        return self.save_message(db, user_id, session_id, "system", "Session started")
+        return await self.save_message(db, user_id, session_id, "system", "Session started")
     
-    def get_chat_history(self, db: Session, session_id: str, limit: int = 50) -> List[Dict[str, str]]:
-        """Get chat history formatted for LLM"""
-        messages = db.query(ChatHistory).filter(
-            ChatHistory.session_id == session_id,
-            ChatHistory.role.in_(["user", "assistant"])
-        ).order_by(ChatHistory.created_at.asc()).limit(limit).all()
+    async def get_chat_history(self, db: AsyncSession, session_id: str, limit: int = 50) -> List[Dict[str, str]]:
+        """Get the latest chat history formatted for LLM (oldest first)"""
+        messages = await self.get_recent_messages(db, session_id, limit)
         
         return [
             {
                 "role": msg.role,
                 "message": msg.message
             }
-            for msg in messages
+            for msg in reversed(messages)
         ]
     
-    def save_chat_message(
+    async def get_recent_messages(
         self,
-        db: Session,
+        db: AsyncSession,
         session_id: str,
-        role: str,
-        message: str
-    ) -> ChatHistory:
-        """Save chat message (simplified, gets user_id from session)"""
-        # Get user_id from existing session messages
-        existing = db.query(ChatHistory).filter(
-            ChatHistory.session_id == session_id
-        ).first()
-        
-        if existing:
-            user_id = existing.user_id
+        limit: int = 100,
+        user_id: Optional[str] = None
+    ) -> List[ChatHistory]:
+        """Get the newest user/assistant messages of a session (newest first)"""
+        query = select(ChatHistory).filter(
+            ChatHistory.session_id == session_id,
+            ChatHistory.role.in_(["user", "assistant"])
+        )
+        if user_id is not None:
+            query = query.filter(ChatHistory.user_id == user_id)
+        query = query.order_by(ChatHistory.created_at.desc(), ChatHistory.id.desc()).limit(limit)
+        return list(await db.scalars(query))
+    
+    async def get_messages_for_summary(
+        self,
+        db: AsyncSession,
+        session_id: str,
+        after_id: int,
+        until_id: int,
+        limit: int = 50
+    ) -> List[ChatHistory]:
+        """Get user/assistant messages with after_id < id <= until_id (oldest first)"""
+        return list(await db.scalars(select(ChatHistory).filter(
+            ChatHistory.session_id == session_id,
+            ChatHistory.role.in_(["user", "assistant"]),
+            ChatHistory.id > after_id,
+            ChatHistory.id <= until_id
+        ).order_by(ChatHistory.id.asc()).limit(limit)))
+    
+    # Session summary operations
+    async def get_session_summary(self, db: AsyncSession, session_id: str) -> Optional[SessionSummary]:
+        """Get rolling summary of a session"""
+        return await db.get(SessionSummary, session_id)
+    
+    async def save_session_summary(
+        self,
+        db: AsyncSession,
+        session_id: str,
+        user_id: str,
+        summary: str,
+        summarized_until_id: int
+    ) -> SessionSummary:
+        """Create or update rolling summary of a session"""
+        db_summary = await self.get_session_summary(db, session_id)
+        if db_summary:
+            db_summary.summary = summary
+            db_summary.summarized_until_id = summarized_until_id
         else:
-            # Fallback - shouldn't happen
-            user_id = "000000001"
+            db_summary = SessionSummary(
+                session_id=session_id,
+                user_id=user_id,
+                summary=summary,
+                summarized_until_id=summarized_until_id
+            )
+            db.add(db_summary)
         
-        return self.save_message(db, user_id, session_id, role, message)
+        await db.commit()
+        await db.refresh(db_summary)
+        return db_summary
     
     # User Details operations
-    def get_user_details(self, db: Session, user_id: str) -> Optional[UserDetails]:
+    async def get_user_details(self, db: AsyncSession, user_id: str) -> Optional[UserDetails]:
         """Get user details"""
-        return db.query(UserDetails).filter(UserDetails.user_id == user_id).first()
+        return await db.scalar(select(UserDetails).filter(UserDetails.user_id == user_id))
     
-    def create_user_details(
+    async def create_user_details(
         self,
-        db: Session,
+        db: AsyncSession,
         user_id: str,
         details: UserDetailsCreate
     ) -> UserDetails:
         """Create user details"""
         db_details = UserDetails(user_id=user_id, **details.model_dump())
         db.add(db_details)
-        db.commit()
-        db.refresh(db_details)
+        await db.commit()
+        await db.refresh(db_details)
         return db_details
     
-    def update_user_details(
+    async def update_user_details(
         self,
-        db: Session,
+        db: AsyncSession,
         user_id: str,
         details: UserDetailsUpdate
     ) -> Optional[UserDetails]:
         """Update user details"""
-        db_details = self.get_user_details(db, user_id)
+        db_details = await self.get_user_details(db, user_id)
         if not db_details:
             return None
         
         for key, value in details.model_dump(exclude_unset=True).items():
             setattr(db_details, key, value)
         
-        db.commit()
-        db.refresh(db_details)
+        await db.commit()
+        await db.refresh(db_details)
         return db_details
     
     # Personal Facts operations
-    def get_personal_facts(self, db: Session, user_id: str) -> List[PersonalFact]:
+    async def get_personal_facts(self, db: AsyncSession, user_id: str) -> List[PersonalFact]:
         """Get all personal facts for a user"""
-        return db.query(PersonalFact).filter(PersonalFact.user_id == user_id).all()
+        return list(await db.scalars(select(PersonalFact).filter(PersonalFact.user_id == user_id)))
     
-    def get_personal_fact(
+    async def get_personal_fact(
         self,
-        db: Session,
+        db: AsyncSession,
         user_id: str,
         fact_key: str
     ) -> Optional[PersonalFact]:
         """Get a specific personal fact"""
-        return db.query(PersonalFact).filter(
+        return await db.scalar(select(PersonalFact).filter(
             PersonalFact.user_id == user_id,
             PersonalFact.fact_key == fact_key
-        ).first()
+        ).limit(1))
     
-    def create_personal_fact(
+    async def create_personal_fact(
         self,
-        db: Session,
+        db: AsyncSession,
         user_id: str,
         fact: PersonalFactCreate
     ) -> PersonalFact:
         """Create a personal fact"""
         db_fact = PersonalFact(user_id=user_id, **fact.model_dump())
         db.add(db_fact)
-        db.commit()
-        db.refresh(db_fact)
+        await db.commit()
+        await db.refresh(db_fact)
         return db_fact
     
-    def update_personal_fact(
+    async def update_personal_fact(
         self,
-        db: Session,
+        db: AsyncSession,
         user_id: str,
         fact_key: str,
         fact: PersonalFactUpdate
     ) -> Optional[PersonalFact]:
         """Update a personal fact"""
-        db_fact = self.get_personal_fact(db, user_id, fact_key)
+        db_fact = await self.get_personal_fact(db, user_id, fact_key)
         if not db_fact:
             return None
         
         db_fact.fact_value = fact.fact_value
-        db.commit()
-        db.refresh(db_fact)
+        await db.commit()
+        await db.refresh(db_fact)
         return db_fact
     
-    def delete_personal_fact(
+    async def delete_personal_fact(
         self,
-        db: Session,
+        db: AsyncSession,
         user_id: str,
         fact_key: str
     ) -> bool:
         """Delete a personal fact"""
-        db_fact = self.get_personal_fact(db, user_id, fact_key)
+        db_fact = await self.get_personal_fact(db, user_id, fact_key)
         if not db_fact:
             return False
         
-        db.delete(db_fact)
-        db.commit()
+        await db.delete(db_fact)
+        await db.commit()
         return True
     
     # Chat History operations
@@ -200,9 +246,9 @@ class DatabaseService(BaseService):
         """Generate a new session ID"""
         return str(uuid.uuid4())
     
-    def save_message(
+    async def save_message(
         self,
-        db: Session,
+        db: AsyncSession,
         user_id: str,
         session_id: str,
         role: str,
@@ -216,40 +262,129 @@ class DatabaseService(BaseService):
             message=message
         )
         db.add(db_message)
-        db.commit()
-        db.refresh(db_message)
+        await self.touch_sessions(db, [{
+            "session_id": session_id,
+            "user_id": user_id,
+            "message_count": 1 if role in ("user", "assistant") else 0,
+            "title": message[:100] if role == "user" else None
+        }])
+        await db.commit()
+        await db.refresh(db_message)
         return db_message
     
-    def get_session_history(
+    async def save_turn(
         self,
-        db: Session,
+        db: AsyncSession,
         user_id: str,
         session_id: str,
-        limit: int = 50
+        user_message: str,
+        assistant_message: str
+    ) -> List[ChatHistory]:
+        """
+        Save the user message and the assistant reply of one turn
+        
+        Both rows go in with a single multi-row INSERT ... RETURNING and the
+        session row is updated in the same transaction, so a turn costs one
+        commit and no refresh round trips.
+        """
+        rows = await db.scalars(
+            insert(ChatHistory).values([
+                {"user_id": user_id, "session_id": session_id, "role": "user", "message": user_message},
+                {"user_id": user_id, "session_id": session_id, "role": "assistant", "message": assistant_message}
+            ]).returning(ChatHistory)
+        )
+        messages = list(rows)
+        await self.touch_sessions(db, [{
+            "session_id": session_id,
+            "user_id": user_id,
+            "message_count": 2,
+            "title": user_message[:100]
+        }])
+        await db.commit()
+        return messages
+    
+    async def touch_sessions(self, db: AsyncSession, sessions: List[Dict[str, Any]]):
+        """
+        Create or update chat_sessions rows for new messages (the caller commits)
+        
+        Each entry has session_id, user_id, message_count, title and
+        optionally last_message_at (the transaction time by default). A
+        session owned by another user is left untouched.
+        """
+        statement = insert(ChatSession).values([
+            {"last_message_at": func.now(), **session}
+            for session in sessions
+        ])
+        statement = statement.on_conflict_do_update(
+            index_elements=[ChatSession.session_id],
+            set_={
+                "message_count": ChatSession.message_count + statement.excluded.message_count,
+                "last_message_at": statement.excluded.last_message_at,
+                "title": func.coalesce(ChatSession.title, statement.excluded.title)
+            },
+            # session_id comes from the client; never count messages into someone else's session
+            where=ChatSession.user_id == statement.excluded.user_id
+        )
+        await db.execute(statement)
+    
+    async def get_session_history(
+        self,
+        db: AsyncSession,
+        user_id: str,
+        session_id: str,
+        limit: int = 50,
+        after: Optional[Tuple[datetime, int]] = None,
+        before: Optional[Tuple[datetime, int]] = None,
+        newest: bool = False
     ) -> List[ChatHistory]:
-        """Get chat history for a session"""
-        return db.query(ChatHistory).filter(
+        """
+        Get a page of chat history for a session (oldest first)
+        
+        Pages are selected by keyset on (created_at, id) instead of OFFSET:
+        `after` returns the messages following that key, `before` the
+        messages preceding it and `newest` the end of the session.
+        By default the session is read from the start.
+        """
+        query = select(ChatHistory).filter(
             ChatHistory.user_id == user_id,
             ChatHistory.session_id == session_id
-        ).order_by(ChatHistory.created_at.asc()).limit(limit).all()
+        )
+        key = tuple_(ChatHistory.created_at, ChatHistory.id)
+        if after is not None:
+            query = query.filter(key > tuple_(*after))
+        if before is not None:
+            query = query.filter(key < tuple_(*before))
+        
+        if before is not None or newest:
+            query = query.order_by(ChatHistory.created_at.desc(), ChatHistory.id.desc()).limit(limit)
+            return list(reversed(list(await db.scalars(query))))
+        
+        query = query.order_by(ChatHistory.created_at.asc(), ChatHistory.id.asc()).limit(limit)
+        return list(await db.scalars(query))
     
-    def get_user_sessions(
+    async def get_user_sessions(
         self,
-        db: Session,
-        user_id: str
-    ) -> List[str]:
-        """Get all session IDs for a user"""
-        sessions = db.query(ChatHistory.session_id).filter(
-            ChatHistory.user_id == user_id
-        ).distinct().all()
-        return [s[0] for s in sessions]
-    
-    def get_user_context(self, db: Session, user_id: str) -> Dict[str, Any]:
+        db: AsyncSession,
+        user_id: str,
+        limit: int = 50,
+        before: Optional[Tuple[datetime, str]] = None
+    ) -> List[ChatSession]:
+        """Get sessions of a user, most recently active first (keyset on last_message_at, session_id)"""
+        query = select(ChatSession).filter(ChatSession.user_id == user_id)
+        if before is not None:
+            query = query.filter(tuple_(ChatSession.last_message_at, ChatSession.session_id) < tuple_(*before))
+        query = query.order_by(
+            ChatSession.last_message_at.desc(),
+            ChatSession.session_id.desc()
+        ).limit(limit)
+        return list(await db.scalars(query))
+    
+    async def get_user_context(self, db: AsyncSession, user_id: str) -> Dict[str, Any]:
         """Get full user context for personalization"""
         context = {}
         
         # Get user details
-        user_details = self.get_user_details(db, user_id)
+        user_details = await self.get_user_details(db, user_id)
         if user_details:
             context['user_details'] = {
                 'full_name': user_details.full_name,
@@ -257,9 +392,10 @@ class DatabaseService(BaseService):
                 'phone': user_details.phone,
                 'bio': user_details.bio
             }
+        context['response_cache_opt_out'] = bool(user_details and user_details.response_cache_opt_out)
         
         # Get personal facts
-        personal_facts = self.get_personal_facts(db, user_id)
+        personal_facts = await self.get_personal_facts(db, user_id)
         context['personal_facts'] = [
             {
                 'fact_key': fact.fact_key,
@@ -280,25 +416,71 @@ class DatabaseService(BaseService):
         return context
     
     # Static Data operations
-    def get_ai_behavior_rules(self, db: Session) -> List[str]:
+    async def get_ai_behavior_rules(self, db: AsyncSession) -> List[str]:
         """Get all active AI behavior rules sorted by priority"""
-        rules = db.query(StaticData).filter(
+        rules = await db.scalars(select(StaticData).filter(
             StaticData.category == 'ai_behavior',
             StaticData.is_active == 1
-        ).order_by(StaticData.priority.desc()).all()
+        ).order_by(StaticData.priority.desc()))
         
         return [rule.value for rule in rules]
     
-    def get_static_data(self, db: Session, category: str) -> List[StaticData]:
+    # Telegram bot state operations (the caller commits)
+    async def get_telegram_session(self, db: AsyncSession, telegram_id: int) -> Optional[str]:
+        """Get the active chat session of a Telegram user"""
+        return await db.scalar(select(TelegramSession.session_id).filter(
+            TelegramSession.telegram_id == telegram_id
+        ))
+    
+    async def set_telegram_session(self, db: AsyncSession, telegram_id: int, session_id: str):
+        """Make a chat session the active one of a Telegram user"""
+        statement = insert(TelegramSession).values(telegram_id=telegram_id, session_id=session_id)
+        await db.execute(statement.on_conflict_do_update(
+            index_elements=[TelegramSession.telegram_id],
+            set_={"session_id": statement.excluded.session_id, "updated_at": func.now()}
+        ))
+    
+    async def delete_telegram_session(self, db: AsyncSession, telegram_id: int):
+        await db.execute(delete(TelegramSession).where(TelegramSession.telegram_id == telegram_id))
+    
+    async def get_fsm_record(self, db: AsyncSession, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        """Get the FSM state and data stored under a key"""
+        row = (await db.execute(select(TelegramFSMState.state, TelegramFSMState.data).filter(
+            TelegramFSMState.key == key
+        ))).first()
+        return (row.state, row.data or {}) if row else (None, {})
+    
+    async def set_fsm_value(self, db: AsyncSession, key: str, column: str, value: Any):
+        """Set the FSM state or data of a key, leaving the other one untouched"""
+        statement = insert(TelegramFSMState).values(key=key, **{column: value})
+        await db.execute(statement.on_conflict_do_update(
+            index_elements=[TelegramFSMState.key],
+            set_={column: getattr(statement.excluded, column), "updated_at": func.now()}
+        ))
+        # Finished flows leave nothing behind
+        await db.execute(delete(TelegramFSMState).where(
+            TelegramFSMState.key == key,
+            TelegramFSMState.state.is_(None),
+            TelegramFSMState.data.is_(None)
+        ))
+    
+    async def get_static_data_version(self, db: AsyncSession, category: str) -> int:
+        """Get the change counter of a static data category"""
+        version = await db.scalar(select(StaticDataVersion.version).filter(
+            StaticDataVersion.category == category
+        ))
+        return version or 0
+    
+    async def get_static_data(self, db: AsyncSession, category: str) -> List[StaticData]:
         """Get all active static data by category"""
-        return db.query(StaticData).filter(
+        return list(await db.scalars(select(StaticData).filter(
             StaticData.category == category,
             StaticData.is_active == 1
-        ).order_by(StaticData.priority.desc()).all()
+        ).order_by(StaticData.priority.desc())))
     
-    def add_static_data(
+    async def add_static_data(
         self,
-        db: Session,
+        db: AsyncSession,
         category: str,
         key: str,
         value: str,
@@ -315,20 +497,20 @@ class DatabaseService(BaseService):
             is_active=1
         )
         db.add(static_data)
-        db.commit()
-        db.refresh(static_data)
+        await db.commit()
+        await db.refresh(static_data)
         return static_data
     
-    def update_static_data(
+    async def update_static_data(
         self,
-        db: Session,
+        db: AsyncSession,
         rule_id: int,
         value: str = None,
         is_active: int = None,
         priority: int = None
     ) -> Optional[StaticData]:
         """Update existing static data rule"""
-        rule = db.query(StaticData).filter(StaticData.id == rule_id).first()
+        rule = await db.get(StaticData, rule_id)
         if not rule:
             return None
         
@@ -339,8 +521,8 @@ class DatabaseService(BaseService):
         if priority is not None:
             rule.priority = priority
         
-        db.commit()
-        db.refresh(rule)
+        await db.commit()
+        await db.refresh(rule)
         return rule
 
 
@@ -0,0 +1,333 @@
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from typing import Callable, Deque, List, Dict, Any, Optional
+from asyncpg.exceptions import DataError as PostgresDataError
+from asyncpg.exceptions import IntegrityConstraintViolationError as PostgresIntegrityError
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import get_settings
+from app.database import AsyncSessionLocal
+from app.models.user import ChatHistory
+from app.services.database_service import db_service
+
+settings = get_settings()
+
+COPY_COLUMNS = ["user_id", "session_id", "role", "message", "created_at"]
+
+
+class HistoryWriter:
+    """
+    Persists chat turns, optionally through a write-behind buffer
+    
+    With HISTORY_WRITE_BEHIND off every turn is written in its own
+    transaction. With it on, turns are queued in memory and a background
+    task writes them in bulk (COPY on asyncpg) every flush interval or
+    batch size. Producers wait when the buffer is full, the buffer is
+    flushed on shutdown, and unflushed messages are merged into history
+    reads so a session always sees its own latest turns.
+    
+    A batch rejected by the database (constraint or data error) is split
+    until the offending rows are found; those are dead-lettered and the
+    rest is written. Other errors (database unreachable) keep the rows and
+    back off. A producer that waits longer than HISTORY_ENQUEUE_TIMEOUT_MS
+    for space writes its rows directly.
+    """
+    
+    MAX_BACKOFF_SECONDS = 30.0
+    DEAD_LETTERS_KEPT = 100
+    
+    def __init__(
+        self,
+        enabled: bool,
+        flush_interval_ms: int,
+        batch_rows: int,
+        max_rows: int,
+        enqueue_timeout_ms: int
+    ):
+        self.enabled = enabled
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_rows = max(1, batch_rows)
+        self.max_rows = max(self.batch_rows, max_rows)
+        self.enqueue_timeout = enqueue_timeout_ms / 1000
+        self._pending: List[ChatHistory] = []
+        self._by_session: Dict[str, List[ChatHistory]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._space: Optional[asyncio.Condition] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._backoff = 0.0
+        self.dead_letters: Deque[Dict[str, Any]] = deque(maxlen=self.DEAD_LETTERS_KEPT)
+        self.stats = {
+            "flushes": 0,
+            "flushed_rows": 0,
+            "failed_flushes": 0,
+            "dead_lettered_rows": 0,
+            "producer_waits": 0,
+            "direct_writes": 0,
+            "last_flush_ms": 0.0
+        }
+    
+    async def save_turn(
+        self,
+        db: AsyncSession,
+        user_id: str,
+        session_id: str,
+        user_message: str,
+        assistant_message: str
+    ):
+        """Save the user message and the assistant reply of one turn"""
+        if not self.enabled:
+            await db_service.save_turn(db, user_id, session_id, user_message, assistant_message)
+            return
+        
+        created_at = datetime.now(timezone.utc)
+        await self._enqueue([
+            ChatHistory(user_id=user_id, session_id=session_id, role="user",
+                        message=user_message, created_at=created_at),
+            ChatHistory(user_id=user_id, session_id=session_id, role="assistant",
+                        message=assistant_message, created_at=created_at)
+        ])
+    
+    async def save_message(
+        self,
+        db: AsyncSession,
+        user_id: str,
+        session_id: str,
+        role: str,
+        message: str
+    ):
+        """Save a single chat message"""
+        if not self.enabled:
+            await db_service.save_message(db, user_id, session_id, role, message)
+            return
+        
+        await self._enqueue([
+            ChatHistory(user_id=user_id, session_id=session_id, role=role,
+                        message=message, created_at=datetime.now(timezone.utc))
+        ])
+    
+    async def save_unanswered(self, db: AsyncSession, user_id: str, session_id: str, message: str):
+        """
+        Keep the user message of a turn whose reply failed or was cancelled
+        
+        Turns are saved in one go after the reply, so without this the
+        message would be lost. Errors are only logged, so the caller can
+        re-raise the original one.
+        """
+        try:
+            await db.rollback()
+            await self.save_message(db, user_id, session_id, "user", message)
+        except Exception as e:
+            print(f"Error saving unanswered message: {e}")
+    
+    def merge_recent(
+        self,
+        session_id: str,
+        user_id: Optional[str],
+        recent: List[ChatHistory],
+        limit: int
+    ) -> List[ChatHistory]:
+        """Add unflushed messages of a session to its newest-first history"""
+        pending = [
+            msg for msg in self._by_session.get(session_id, [])
+            if user_id is None or msg.user_id == user_id
+        ]
+        if not pending:
+            return recent
+        
+        # A batch may be committed while the history was being read
+        stored = {(msg.created_at, msg.role, msg.message) for msg in recent}
+        pending = [msg for msg in pending if (msg.created_at, msg.role, msg.message) not in stored]
+        return (list(reversed(pending)) + recent)[:limit]
+    
+    async def ensure_flushed(self, session_id: Optional[str] = None, user_id: Optional[str] = None):
+        """Write the buffered messages a read needs (of a session or of a user) now"""
+        if session_id is not None:
+            if session_id in self._by_session:
+                await self.flush(lambda row: row.session_id == session_id)
+        elif user_id is not None:
+            if any(row.user_id == user_id for row in self._pending):
+                await self.flush(lambda row: row.user_id == user_id)
+        elif self._pending:
+            await self.flush()
+    
+    async def _enqueue(self, rows: List[ChatHistory]):
+        self._ensure_started()
+        
+        # Backpressure: wait for a flush instead of growing without bound
+        if len(self._pending) + len(rows) > self.max_rows:
+            self.stats["producer_waits"] += 1
+            self._wakeup.set()
+            try:
+                async with self._space:
+                    await asyncio.wait_for(
+                        self._space.wait_for(lambda: len(self._pending) + len(rows) <= self.max_rows),
+                        timeout=self.enqueue_timeout
+                    )
+            except asyncio.TimeoutError:
+                # Flushes are not keeping up (or failing): write like without the buffer
+                self.stats["direct_writes"] += 1
+                await self._write(rows)
+                return
+        
+        for row in rows:
+            self._pending.append(row)
+            self._by_session.setdefault(row.session_id, []).append(row)
+        
+        if len(self._pending) >= self.batch_rows:
+            self._wakeup.set()
+    
+    def _ensure_started(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Condition()
+        self._flush_lock = asyncio.Lock()
+        # Detached from the request context so flushes are not timed as part of a request
+        self._task = asyncio.create_task(self._run(), context=contextvars.Context())
+    
+    async def _run(self):
+        while True:
+            if self._backoff:
+                # Early wakeups must not hammer a failing database
+                await asyncio.sleep(self._backoff)
+            else:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+            if self._pending:
+                await self.flush()
+    
+    async def flush(self, selector: Optional[Callable[[ChatHistory], bool]] = None):
+        """Write the buffered messages (all, or those matching `selector`) batch by batch"""
+        if self._flush_lock is None:
+            return
+        async with self._flush_lock:
+            while True:
+                rows = self._pending if selector is None else [row for row in self._pending if selector(row)]
+                batch = rows[:self.batch_rows]
+                if not batch:
+                    break
+                started = time.monotonic()
+                if not await self._write_batch(batch):
+                    # Keep the rows; the next flush retries them
+                    self.stats["failed_flushes"] += 1
+                    self._backoff = min(max(self.flush_interval, self._backoff * 2), self.MAX_BACKOFF_SECONDS)
+                    break
+                
+                self._backoff = 0.0
+                self.stats["flushes"] += 1
+                self.stats["last_flush_ms"] = round((time.monotonic() - started) * 1000, 1)
+    
+    async def _write_batch(self, batch: List[ChatHistory]) -> bool:
+        """Write a batch, splitting it to dead-letter rows the database rejects; False on other errors"""
+        try:
+            await self._write(batch)
+        except (IntegrityError, DataError, PostgresIntegrityError, PostgresDataError) as e:
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                return await self._write_batch(batch[:middle]) and await self._write_batch(batch[middle:])
+            row = batch[0]
+            print(f"Dropping chat history row of session {row.session_id} rejected by the database: {e}")
+            self.dead_letters.append({
+                **{column: getattr(row, column) for column in COPY_COLUMNS},
+                "error": str(e)
+            })
+            self.stats["dead_lettered_rows"] += 1
+            await self._remove(batch)
+            return True
+        except Exception as e:
+            print(f"Error flushing chat history: {e}")
+            return False
+        
+        self.stats["flushed_rows"] += len(batch)
+        await self._remove(batch)
+        return True
+    
+    async def _remove(self, batch: List[ChatHistory]):
+        written = {id(row) for row in batch}
+        self._pending = [row for row in self._pending if id(row) not in written]
+        for row in batch:
+            session_rows = self._by_session[row.session_id]
+            session_rows.remove(row)
+            if not session_rows:
+                del self._by_session[row.session_id]
+        
+        async with self._space:
+            self._space.notify_all()
+    
+    async def _write(self, batch: List[ChatHistory]):
+        sessions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        for row in batch:
+            session = sessions.setdefault(row.session_id, {
+                "session_id": row.session_id,
+                "user_id": row.user_id,
+                "message_count": 0,
+                "title": None
+            })
+            if row.role in ("user", "assistant"):
+                session["message_count"] += 1
+            session["last_message_at"] = row.created_at
+            if session["title"] is None and row.role == "user":
+                session["title"] = row.message[:100]
+        
+        async with AsyncSessionLocal() as db:
+            # The upsert opens the transaction the COPY then runs in
+            await db_service.touch_sessions(db, list(sessions.values()))
+            
+            connection = await db.connection()
+            records = [tuple(getattr(row, column) for column in COPY_COLUMNS) for row in batch]
+            if connection.dialect.driver == "asyncpg":
+                raw_connection = await connection.get_raw_connection()
+                await raw_connection.driver_connection.copy_records_to_table(
+                    ChatHistory.__tablename__,
+                    records=records,
+                    columns=COPY_COLUMNS
+                )
+            else:
+                await db.execute(insert(ChatHistory).values([
+                    dict(zip(COPY_COLUMNS, record)) for record in records
+                ]))
+            
+            await db.commit()
+    
+    async def stop(self):
+        """Stop the background task and write everything still buffered"""
+        if self._task is not None:
+            # Holding the lock, the task is between flushes and can be cancelled without losing a write
+            async with self._flush_lock:
+                self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._backoff = 0.0
+        await self.flush()
+        if self._pending:
+            print(f"Could not write {len(self._pending)} buffered chat history rows on shutdown")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "pending_rows": len(self._pending),
+            "pending_sessions": len(self._by_session),
+            "backoff_seconds": self._backoff,
+            **self.stats
+        }
+
+
+# Singleton instance
+history_writer = HistoryWriter(
+    settings.HISTORY_WRITE_BEHIND,
+    settings.HISTORY_FLUSH_INTERVAL_MS,
+    settings.HISTORY_FLUSH_BATCH_ROWS,
+    settings.HISTORY_BUFFER_MAX_ROWS,
+    settings.HISTORY_ENQUEUE_TIMEOUT_MS
+)
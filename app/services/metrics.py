@@ -0,0 +1,171 @@
+from typing import Any, Mapping
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# HTTP API
+HTTP_REQUESTS = Counter(
+    "chatbot_http_requests_total",
+    "HTTP requests handled by the API",
+    ["method", "route", "status"]
+)
+HTTP_LATENCY = Histogram(
+    "chatbot_http_request_duration_seconds",
+    "HTTP request latency until the response headers are sent",
+    ["method", "route"],
+    buckets=LATENCY_BUCKETS
+)
+
+# Telegram bot
+TELEGRAM_UPDATES = Counter(
+    "chatbot_telegram_handler_calls_total",
+    "Telegram updates handled per aiogram handler",
+    ["handler", "status"]
+)
+TELEGRAM_LATENCY = Histogram(
+    "chatbot_telegram_handler_duration_seconds",
+    "Telegram handler latency",
+    ["handler"],
+    buckets=LATENCY_BUCKETS
+)
+TELEGRAM_QUEUED_UPDATES = Gauge(
+    "chatbot_telegram_queued_updates",
+    "Telegram updates of chats waiting for their turn or in progress"
+)
+TELEGRAM_QUEUE_WAIT = Histogram(
+    "chatbot_telegram_queue_wait_seconds",
+    "Time a Telegram update waits for the previous updates of its chat and a free worker",
+    buckets=LATENCY_BUCKETS
+)
+TELEGRAM_ACTIVE_SESSIONS = Gauge(
+    "chatbot_telegram_active_sessions",
+    "Active Telegram chat sessions cached by the bot process"
+)
+
+# Ollama
+OLLAMA_GENERATED_TOKENS = Counter(
+    "chatbot_ollama_generated_tokens_total",
+    "Tokens generated by Ollama"
+)
+OLLAMA_PROMPT_TOKENS = Counter(
+    "chatbot_ollama_prompt_tokens_total",
+    "Prompt tokens evaluated by Ollama"
+)
+OLLAMA_TOKENS_PER_SECOND = Histogram(
+    "chatbot_ollama_tokens_per_second",
+    "Ollama decode speed per generation",
+    buckets=(1, 2.5, 5, 10, 15, 20, 30, 50, 75, 100, 150, 200)
+)
+
+# Database
+DB_CHECKOUT_WAIT = Histogram(
+    "chatbot_db_pool_checkout_wait_seconds",
+    "Time spent waiting for a connection from the SQLAlchemy pool",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0, 30.0)
+)
+
+
+def observe_generation(chunk: Mapping[str, Any]):
+    """Record token counts and decode speed from Ollama's final response chunk"""
+    eval_count = chunk.get("eval_count") or 0
+    eval_duration = chunk.get("eval_duration") or 0
+    OLLAMA_GENERATED_TOKENS.inc(eval_count)
+    OLLAMA_PROMPT_TOKENS.inc(chunk.get("prompt_eval_count") or 0)
+    if eval_count and eval_duration:
+        OLLAMA_TOKENS_PER_SECOND.observe(eval_count / (eval_duration / 1e9))
+
+
+class ServiceStatsCollector:
+    """Exports the in-process stats of the services at scrape time"""
+    
+    def describe(self):
+        # Nothing to describe up front; avoids collecting (and importing the services) on registration
+        return []
+    
+    def collect(self):
+        from app.database import async_engine
+        from app.services.history_writer import history_writer
+        from app.services.ollama_service import ollama_service
+        from app.services.timing import stage_histograms
+        
+        # Generation scheduler
+        scheduler = ollama_service.scheduler.get_stats()
+        active = GaugeMetricFamily("chatbot_scheduler_active", "Generations currently running")
+        active.add_metric([], scheduler["active"])
+        yield active
+        
+        queued = GaugeMetricFamily(
+            "chatbot_scheduler_queue_depth", "Generations waiting for a slot", labels=["priority"]
+        )
+        wait_avg = GaugeMetricFamily(
+            "chatbot_scheduler_wait_avg_seconds", "Average wait for a generation slot", labels=["priority"]
+        )
+        for priority, depth in scheduler["queued"].items():
+            queued.add_metric([priority], depth)
+            wait_avg.add_metric([priority], scheduler["wait_time"][priority]["avg_ms"] / 1000)
+        yield queued
+        yield wait_avg
+        
+        # Ollama backends
+        in_flight = GaugeMetricFamily(
+            "chatbot_ollama_backend_in_flight", "Outstanding requests per Ollama backend", labels=["host"]
+        )
+        up = GaugeMetricFamily(
+            "chatbot_ollama_backend_up", "1 if the backend circuit breaker is closed", labels=["host"]
+        )
+        for backend in ollama_service.pool.get_status():
+            in_flight.add_metric([backend["host"]], backend["in_flight"])
+            up.add_metric([backend["host"]], 1 if backend["state"] == "closed" else 0)
+        yield in_flight
+        yield up
+        
+        # Response cache
+        cache = ollama_service.response_cache.get_stats()
+        lookups = CounterMetricFamily(
+            "chatbot_response_cache_lookups", "Response cache lookups by result", labels=["result"]
+        )
+        for result in ("exact_hits", "semantic_hits", "misses", "bypassed"):
+            lookups.add_metric([result], cache[result])
+        yield lookups
+        
+        hit_rate = GaugeMetricFamily("chatbot_response_cache_hit_rate", "Response cache hit rate")
+        hit_rate.add_metric([], cache["hit_rate"])
+        yield hit_rate
+        
+        # Database pool
+        checked_out = GaugeMetricFamily("chatbot_db_pool_checked_out", "Connections checked out of the pool")
+        checked_out.add_metric([], async_engine.pool.checkedout())
+        yield checked_out
+        
+        # Chat history write-behind buffer
+        writer = history_writer.get_stats()
+        pending = GaugeMetricFamily("chatbot_history_pending_rows", "Chat messages buffered but not yet written")
+        pending.add_metric([], writer["pending_rows"])
+        yield pending
+        
+        flushed = CounterMetricFamily("chatbot_history_flushed_rows", "Chat messages written by the history writer")
+        flushed.add_metric([], writer["flushed_rows"])
+        yield flushed
+        
+        dead_lettered = CounterMetricFamily(
+            "chatbot_history_dead_lettered_rows", "Chat messages dropped because the database rejected them"
+        )
+        dead_lettered.add_metric([], writer["dead_lettered_rows"])
+        yield dead_lettered
+        
+        # Chat turn stages
+        stages = HistogramMetricFamily(
+            "chatbot_chat_stage_duration_seconds", "Duration of chat turn stages", labels=["source", "stage"]
+        )
+        for source, source_stages in stage_histograms.snapshot().items():
+            for stage_name, histogram in source_stages.items():
+                stages.add_metric(
+                    [source, stage_name],
+                    list(histogram["buckets"].items()),
+                    histogram["sum"]
+                )
+        yield stages
+
+
+REGISTRY.register(ServiceStatsCollector())
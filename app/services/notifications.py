@@ -0,0 +1,96 @@
+import asyncio
+import contextvars
+from typing import Callable, Dict, List, Optional
+import asyncpg
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import get_settings
+
+settings = get_settings()
+
+
+class NotificationListener:
+    """
+    PostgreSQL LISTEN connection shared by the caches of a process
+    
+    Handlers get the payload of every NOTIFY on their channel. The
+    connection is re-established after a failure; notifications sent
+    while it was down are lost, so `on_connect` callbacks run after every
+    (re)connect to let subscribers resynchronize.
+    """
+    
+    RECONNECT_SECONDS = 5
+    
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self._handlers: Dict[str, List[Callable[[str], None]]] = {}
+        self._on_connect: List[Callable[[], None]] = []
+        self._connection: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self.connected = False
+    
+    async def subscribe(
+        self,
+        channel: str,
+        handler: Callable[[str], None],
+        on_connect: Optional[Callable[[], None]] = None
+    ):
+        """Register a handler and make sure the listener is running"""
+        new_channel = channel not in self._handlers
+        self._handlers.setdefault(channel, []).append(handler)
+        if on_connect is not None:
+            self._on_connect.append(on_connect)
+        
+        if self._connection is not None and new_channel:
+            await self._connection.add_listener(channel, self._dispatch)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), context=contextvars.Context())
+    
+    @staticmethod
+    async def publish(db: AsyncSession, channel: str, payload: str):
+        """Send a NOTIFY delivered when the caller commits (no-op outside PostgreSQL)"""
+        if db.get_bind().dialect.name == "postgresql":
+            await db.execute(select(func.pg_notify(channel, payload)))
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        while True:
+            try:
+                self._connection = await asyncpg.connect(self.dsn)
+                lost = asyncio.Event()
+                self._connection.add_termination_listener(lambda _: lost.set())
+                for channel in list(self._handlers):
+                    await self._connection.add_listener(channel, self._dispatch)
+                self.connected = True
+                for callback in self._on_connect:
+                    callback()
+                await lost.wait()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Notification listener error: {e}")
+            finally:
+                self.connected = False
+                if self._connection is not None:
+                    self._connection.terminate()
+                    self._connection = None
+            await asyncio.sleep(self.RECONNECT_SECONDS)
+    
+    def _dispatch(self, connection, pid: int, channel: str, payload: str):
+        for handler in self._handlers.get(channel, []):
+            try:
+                handler(payload)
+            except Exception as e:
+                print(f"Error handling notification on {channel}: {e}")
+
+
+# Singleton instance
+notification_listener = NotificationListener(settings.database_url)
@@ -0,0 +1,172 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, Optional
+import ollama
+
+
+class NoBackendAvailable(Exception):
+    """Raised when every Ollama backend is ejected by its circuit breaker"""
+
+
+class OllamaBackend:
+    """Single Ollama host with its client, load and circuit breaker state"""
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    # Weight of the newest sample in the latency moving average
+    LATENCY_ALPHA = 0.2
+    
+    def __init__(self, host: str):
+        self.host = host
+        self.client = ollama.AsyncClient(host=host)
+        self.in_flight = 0
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.total_requests = 0
+        self.total_failures = 0
+        self.latency_ewma: Optional[float] = None
+        self.last_error: Optional[str] = None
+    
+    def is_available(self, recovery_seconds: float) -> bool:
+        """Whether the backend may receive a request right now"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at >= recovery_seconds
+        # Half-open: let a single probe request through
+        return self.in_flight == 0
+    
+    def record_success(self, latency: float):
+        self.total_requests += 1
+        self.consecutive_failures = 0
+        self.state = self.CLOSED
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma += self.LATENCY_ALPHA * (latency - self.latency_ewma)
+    
+    def record_failure(self, error: Exception, failure_threshold: int):
+        self.total_requests += 1
+        self.total_failures += 1
+        self.consecutive_failures += 1
+        self.last_error = str(error)
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= failure_threshold:
+            if self.state != self.OPEN:
+                print(f"⚠️ Ollama backend {self.host} ejected after {self.consecutive_failures} failures: {error}")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "host": self.host,
+            "state": self.state,
+            "in_flight": self.in_flight,
+            "latency_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            "requests": self.total_requests,
+            "failures": self.total_failures,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error
+        }
+
+
+class OllamaPool:
+    """
+    Pool of Ollama backends with health-aware load balancing
+    
+    Requests go to the available backend with the fewest outstanding
+    requests (ties broken by latency). A backend that fails
+    `failure_threshold` times in a row is ejected for `recovery_seconds`,
+    then re-admitted after a successful probe request.
+    """
+    
+    def __init__(self, hosts: List[str], failure_threshold: int = 3, recovery_seconds: float = 30.0):
+        self.backends = [OllamaBackend(host) for host in hosts]
+        self.failure_threshold = max(1, failure_threshold)
+        self.recovery_seconds = recovery_seconds
+    
+    def get_backend(self, host: str) -> Optional[OllamaBackend]:
+        """Find a backend by host"""
+        for backend in self.backends:
+            if backend.host == host:
+                return backend
+        return None
+    
+    def _select(self, preferred: Optional[str] = None) -> OllamaBackend:
+        candidates = [b for b in self.backends if b.is_available(self.recovery_seconds)]
+        if not candidates:
+            raise NoBackendAvailable("All Ollama backends are unavailable")
+        
+        if preferred:
+            for backend in candidates:
+                if backend.host == preferred:
+                    return backend
+        
+        return min(
+            candidates,
+            key=lambda b: (b.in_flight, b.latency_ewma if b.latency_ewma is not None else 0.0)
+        )
+    
+    @asynccontextmanager
+    async def acquire(self, preferred: Optional[str] = None):
+        """
+        Pick a backend and track the request made inside the block
+        
+        Args:
+            preferred: Host to use if it is currently available
+        
+        Yields:
+            Selected OllamaBackend
+        """
+        backend = self._select(preferred)
+        if backend.state == OllamaBackend.OPEN:
+            backend.state = OllamaBackend.HALF_OPEN
+        
+        backend.in_flight += 1
+        started = time.monotonic()
+        try:
+            yield backend
+        except ollama.ResponseError as e:
+            # 4xx means the request itself was bad, not the host
+            if e.status_code >= 500 or e.status_code < 0:
+                backend.record_failure(e, self.failure_threshold)
+            else:
+                backend.record_success(time.monotonic() - started)
+            raise
+        except Exception as e:
+            backend.record_failure(e, self.failure_threshold)
+            raise
+        else:
+            backend.record_success(time.monotonic() - started)
+        finally:
+            backend.in_flight -= 1
+    
+    async def _probe(self, backend: OllamaBackend) -> Optional[Dict[str, Any]]:
+        started = time.monotonic()
+        try:
+            models = await backend.client.list()
+        except Exception as e:
+            backend.record_failure(e, self.failure_threshold)
+            return None
+        backend.record_success(time.monotonic() - started)
+        return models
+    
+    async def list_models(self) -> Dict[str, Any]:
+        """Probe every backend and return the model list of each reachable one"""
+        results = await asyncio.gather(*(self._probe(b) for b in self.backends))
+        return {
+            backend.host: models
+            for backend, models in zip(self.backends, results)
+            if models is not None
+        }
+    
+    async def health_check(self) -> bool:
+        """Probe every backend; healthy if at least one responds"""
+        return bool(await self.list_models())
+    
+    def get_status(self) -> List[Dict[str, Any]]:
+        """Per-backend status for health reporting"""
+        return [backend.get_status() for backend in self.backends]
@@ -1,21 +1,256 @@
-from typing import List, Dict, Any, Optional
-import ollama
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import List, Dict, Any, Optional, AsyncIterator, Deque
 from app.config import get_settings
 from app.services.base import BaseService
-from app.database import SessionLocal
+from app.services.ollama_pool import OllamaPool
+from app.services.response_cache import ResponseCache
+from app.services.ai_rules import AIRulesStore
+from app.services.timing import stage, record_stage, record_ollama_stats
+from app.services.metrics import observe_generation
 
 settings = get_settings()
 
 
+class GenerationPriority(IntEnum):
+    """Priority classes for generation requests (lower value runs first)"""
+    INTERACTIVE = 0
+    GREETING = 1
+    BACKGROUND = 2
+
+
+class GenerationScheduler:
+    """
+    Admission control in front of Ollama
+    
+    Limits the number of concurrent generations, serves waiting requests
+    strictly by priority class and round-robin across users within a class,
+    so one heavy user cannot starve everyone else.
+    """
+    
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max(1, max_concurrency)
+        self._active = 0
+        self._queues: Dict[GenerationPriority, "OrderedDict[str, Deque[asyncio.Future]]"] = {
+            priority: OrderedDict() for priority in GenerationPriority
+        }
+        self._wait_stats: Dict[GenerationPriority, Dict[str, float]] = {
+            priority: {"count": 0, "total": 0.0, "max": 0.0} for priority in GenerationPriority
+        }
+    
+    @asynccontextmanager
+    async def slot(self, user_id: Optional[str], priority: GenerationPriority = GenerationPriority.INTERACTIVE):
+        """Wait for a generation slot and hold it for the duration of the block"""
+        await self._acquire(user_id or "anonymous", priority)
+        try:
+            yield
+        finally:
+            self._release()
+    
+    def queue_depth(self) -> int:
+        """Number of requests waiting for a slot"""
+        return sum(
+            len(waiters)
+            for users in self._queues.values()
+            for waiters in users.values()
+        )
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Queue depth and wait-time statistics"""
+        queued = {}
+        wait_time = {}
+        for priority in GenerationPriority:
+            name = priority.name.lower()
+            queued[name] = sum(len(waiters) for waiters in self._queues[priority].values())
+            stats = self._wait_stats[priority]
+            wait_time[name] = {
+                "count": int(stats["count"]),
+                "avg_ms": round(stats["total"] / stats["count"] * 1000, 1) if stats["count"] else 0.0,
+                "max_ms": round(stats["max"] * 1000, 1)
+            }
+        
+        return {
+            "max_concurrency": self.max_concurrency,
+            "active": self._active,
+            "queue_depth": sum(queued.values()),
+            "queued": queued,
+            "wait_time": wait_time
+        }
+    
+    async def _acquire(self, user_id: str, priority: GenerationPriority):
+        if self._active < self.max_concurrency and self.queue_depth() == 0:
+            self._active += 1
+            self._record_wait(priority, 0.0)
+            return
+        
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues[priority].setdefault(user_id, deque()).append(waiter)
+        started = time.monotonic()
+        
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over right before cancellation
+                self._release()
+            else:
+                self._remove_waiter(user_id, priority, waiter)
+            raise
+        
+        self._record_wait(priority, time.monotonic() - started)
+    
+    def _release(self):
+        self._active -= 1
+        self._dispatch()
+    
+    def _dispatch(self):
+        """Hand free slots to waiters: highest priority first, round-robin across users"""
+        while self._active < self.max_concurrency:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            self._active += 1
+            waiter.set_result(None)
+    
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        for priority in GenerationPriority:
+            users = self._queues[priority]
+            while users:
+                user_id, waiters = next(iter(users.items()))
+                waiter = waiters.popleft()
+                if waiters:
+                    users.move_to_end(user_id)
+                else:
+                    del users[user_id]
+                if not waiter.done():
+                    return waiter
+        return None
+    
+    def _remove_waiter(self, user_id: str, priority: GenerationPriority, waiter: asyncio.Future):
+        waiters = self._queues[priority].get(user_id)
+        if waiters is None:
+            return
+        try:
+            waiters.remove(waiter)
+        except ValueError:
+            pass
+        if not waiters:
+            del self._queues[priority][user_id]
+    
+    def _record_wait(self, priority: GenerationPriority, seconds: float):
+        record_stage("ollama_queue", seconds)
+        stats = self._wait_stats[priority]
+        stats["count"] += 1
+        stats["total"] += seconds
+        stats["max"] = max(stats["max"], seconds)
+
+
+class SessionContextStore:
+    """
+    Per-session Ollama generation context (the `context` token state
+    returned by the generate API) with LRU and TTL eviction
+    
+    The store is per process, so every entry records the turn it ends
+    with. An entry is only reused while that turn is still the last one
+    of the session history; otherwise turns were added elsewhere (another
+    worker, a cached answer) or the last generation did not complete.
+    """
+    
+    def __init__(self, max_sessions: int, ttl_seconds: float, max_tokens: int):
+        self.max_sessions = max(1, max_sessions)
+        self.ttl_seconds = ttl_seconds
+        self.max_tokens = max_tokens
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.stats = {
+            "turns": 0,
+            "reused_turns": 0,
+            "reused_tokens": 0,
+            "prompt_eval_tokens": 0
+        }
+    
+    @staticmethod
+    def turn_fingerprint(user_message: str, assistant_message: str) -> str:
+        return hashlib.sha256(f"{user_message}\x00{assistant_message}".encode('utf-8')).hexdigest()
+    
+    def get(self, session_id: str, chat_history: List[Dict[str, str]]) -> Optional[Dict[str, Any]]:
+        """Stored context of a session, if it matches the end of the session history"""
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry["updated_at"] > self.ttl_seconds:
+            del self._entries[session_id]
+            return None
+        
+        last_turn = chat_history[-2:]
+        if (
+            len(last_turn) < 2
+            or last_turn[0]["role"] != "user"
+            or last_turn[1]["role"] != "assistant"
+            or self.turn_fingerprint(last_turn[0]["message"], last_turn[1]["message"]) != entry["last_turn"]
+        ):
+            del self._entries[session_id]
+            return None
+        
+        self._entries.move_to_end(session_id)
+        return entry
+    
+    def put(self, session_id: str, entry: Dict[str, Any]):
+        if len(entry["context"]) > self.max_tokens:
+            # Too long to extend, the next turn starts from the (trimmed) history again
+            self.discard(session_id)
+            return
+        entry["updated_at"] = time.monotonic()
+        self._entries[session_id] = entry
+        self._entries.move_to_end(session_id)
+        while len(self._entries) > self.max_sessions:
+            self._entries.popitem(last=False)
+    
+    def discard(self, session_id: str):
+        self._entries.pop(session_id, None)
+    
+    def record_turn(self, reused_tokens: int, prompt_eval_count: int):
+        """Account prompt evaluation avoided by reusing a stored context"""
+        self.stats["turns"] += 1
+        if reused_tokens:
+            self.stats["reused_turns"] += 1
+        self.stats["reused_tokens"] += reused_tokens
+        self.stats["prompt_eval_tokens"] += prompt_eval_count
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": settings.OLLAMA_CONTEXT_REUSE,
+            "sessions": len(self._entries),
+            **self.stats
+        }
+
+
 class OllamaService(BaseService):
     """Service for interacting with Ollama LLM"""
     
     def __init__(self):
         self.model = settings.OLLAMA_MODEL
-        self.base_url = settings.OLLAMA_BASE_URL
-        self.client = None
-        self._ai_rules_cache = None
+        self.pool = OllamaPool(
+            settings.ollama_backends,
+            failure_threshold=settings.OLLAMA_FAILURE_THRESHOLD,
+            recovery_seconds=settings.OLLAMA_RECOVERY_SECONDS
+        )
+        self.scheduler = GenerationScheduler(settings.OLLAMA_MAX_CONCURRENCY)
+        self.session_contexts = SessionContextStore(
+            settings.OLLAMA_CONTEXT_MAX_SESSIONS,
+            settings.OLLAMA_CONTEXT_TTL_SECONDS,
+            settings.OLLAMA_CONTEXT_MAX_TOKENS
+        )
+        self.ai_rules = AIRulesStore(settings.AI_RULES_POLL_SECONDS)
         self._search_service = None
+        self.response_cache = ResponseCache(
+            settings.RESPONSE_CACHE_MAX_ENTRIES,
+            settings.RESPONSE_CACHE_TTL_SECONDS,
+            settings.RESPONSE_CACHE_SIMILARITY
+        )
     
     def _get_search_service(self):
         """Lazy load search service"""
@@ -24,32 +259,22 @@ class OllamaService(BaseService):
             self._search_service = search_service
         return self._search_service
     
-    def _get_ai_behavior_rules(self) -> List[str]:
-        """Get AI behavior rules from database (with caching)"""
-        if self._ai_rules_cache is None:
-            db = SessionLocal()
-            try:
-                from app.services.database_service import db_service
-                self._ai_rules_cache = db_service.get_ai_behavior_rules(db)
-            except Exception as e:
-                print(f"Error loading AI rules: {e}")
-                self._ai_rules_cache = []
-            finally:
-                db.close()
-        
-        return self._ai_rules_cache
-    
-    def reload_ai_rules(self):
+    async def reload_ai_rules(self) -> List[str]:
         """Force reload AI behavior rules from database"""
-        self._ai_rules_cache = None
-        return self._get_ai_behavior_rules()
+        snapshot = await self.ai_rules.reload()
+        return snapshot["rules"]
     
     async def initialize(self) -> bool:
         """Initialize Ollama service"""
         try:
-            # Check if model exists
-            models = ollama.list()
-            model_exists = any(m['name'] == self.model for m in models.get('models', []))
+            # Check if model exists on the reachable backends
+            backend_models = await self.pool.list_models()
+            model_exists = False
+            for host, models in backend_models.items():
+                if any(m['name'] == self.model for m in models.get('models', [])):
+                    model_exists = True
+                else:
+                    print(f"Model {self.model} not found on {host}.")
             
             if not model_exists:
                 print(f"Model {self.model} not found. It needs to be pulled first.")
@@ -63,8 +288,7 @@ class OllamaService(BaseService):
     async def health_check(self) -> bool:
         """Check if Ollama is running"""
         try:
-            ollama.list()
-            return True
+            return await self.pool.health_check()
         except Exception:
             return False
     
@@ -92,12 +316,12 @@ class OllamaService(BaseService):
             return "\n".join(context_parts)
         return ""
     
-    def create_greeting_message(self, user_data: Dict[str, Any]) -> str:
+    async def create_greeting_message(self, user_data: Dict[str, Any], user_id: Optional[str] = None) -> str:
         """Create initial greeting message using LLM"""
         user_name = "друг"
         user_info = ""
         language = settings.DEFAULT_LANGUAGE
-
+        
         print(f"language detected: {language}")
         
         if user_data.get('user_details'):
@@ -136,18 +360,19 @@ class OllamaService(BaseService):
 - Пиши ОБЯЗАТЕЛЬНО на языке: {language}
 
 Только текст приветствия без пояснений:"""
-            
-            response = ollama.chat(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": f"Ты создаешь дружелюбные персональные приветствия на языке: {language}."},
-                    {"role": "user", "content": prompt}
-                ]
-            )
+
+            async with self.scheduler.slot(user_id, GenerationPriority.GREETING), self.pool.acquire() as backend:
+                response = await backend.client.chat(
+                    model=self.model,
+                    messages=[
+                        {"role": "system", "content": f"Ты создаешь дружелюбные персональные приветствия на языке: {language}."},
+                        {"role": "user", "content": prompt}
+                    ]
+                )
             
             greeting = response['message']['content'].strip()
             return greeting
-            
+        
         except Exception as e:
             print(f"Error generating greeting: {e}")
             # Fallback to simple greeting
@@ -183,7 +408,7 @@ class OllamaService(BaseService):
         
         return False, ""
     
-    def _perform_search_and_summarize(self, query: str, language: str) -> Optional[str]:
+    async def _perform_search_and_summarize(self, query: str, language: str) -> Optional[str]:
         """
         Perform web search and summarize results using LLM
         
@@ -197,8 +422,8 @@ class OllamaService(BaseService):
         try:
             search_service = self._get_search_service()
             
-            # Perform search
-            search_results = search_service.search_web(query, num_results=5)
+            # Perform search (blocking HTTP, so keep it off the event loop)
+            search_results = await asyncio.to_thread(search_service.search_web, query, num_results=5)
             
             if not search_results:
                 return None
@@ -207,86 +432,496 @@ class OllamaService(BaseService):
             formatted_results = search_service.format_search_results(search_results)
             
             return formatted_results
-            
+        
         except Exception as e:
             print(f"Error performing search: {e}")
             return None
     
-    async def chat(
+    async def _get_search_results(self, message: str, language: str) -> Optional[str]:
+        """Run a web search if the user explicitly asked for one"""
+        search_requested, search_query = self._check_if_search_requested(message)
+        if search_requested and settings.GOOGLE_SEARCH_ENABLED:
+            print(f"🔍 User requested web search for: {search_query[:50]}...")
+            return await self._perform_search_and_summarize(search_query, language)
+        return None
+    
+    def _build_system_prompt(
         self,
-        message: str,
-        chat_history: List[Dict[str, str]],
-        user_context: Optional[str] = None
+        ai_rules_block: str,
+        user_context: Optional[str] = None,
+        search_results: Optional[str] = None,
+        message_language: Optional[str] = None,
+        history_summary: Optional[str] = None
     ) -> str:
-        """Send a message to Ollama and get response"""
-        try:
-            # Detect message language
-            message_language = self._detect_language(message)
-            
-            # Get AI behavior rules
-            ai_rules = self._get_ai_behavior_rules()
-            
-            # Check if user explicitly requested web search
-            search_results = None
-            search_requested, search_query = self._check_if_search_requested(message)
-            if search_requested and settings.GOOGLE_SEARCH_ENABLED:
-                print(f"🔍 User requested web search for: {search_query[:50]}...")
-                search_results = self._perform_search_and_summarize(search_query, message_language)
-            
-            messages = []
-            
-            # Build system message
-            system_parts = []
-            
-            # Add AI behavior rules
-            if ai_rules:
-                system_parts.append("ПРАВИЛА ПОВЕДЕНИЯ:")
-                for i, rule in enumerate(ai_rules, 1):
-                    system_parts.append(f"{i}. {rule}")
-                system_parts.append("")  # Empty line
-            
-            # Add search results if available
-            if search_results:
-                system_parts.append(search_results)
-                system_parts.append("ВАЖНО: Используй эту актуальную информацию из интернета для ответа на вопрос пользователя.")
-                system_parts.append("")  # Empty line
-            
-            # Add user context if available
-            if user_context:
-                system_parts.append("ИНФОРМАЦИЯ О ПОЛЬЗОВАТЕЛЕ:")
-                system_parts.append(user_context)
-                system_parts.append("")  # Empty line
-            
-            # Add language instruction
+        """Build the system prompt; without search results and language it is stable across turns"""
+        system_parts = []
+        
+        # Add AI behavior rules (rendered once per rules version)
+        if ai_rules_block:
+            system_parts.append(ai_rules_block)
+        
+        # Add search results if available
+        if search_results:
+            system_parts.append(search_results)
+            system_parts.append("ВАЖНО: Используй эту актуальную информацию из интернета для ответа на вопрос пользователя.")
+            system_parts.append("")  # Empty line
+        
+        # Add user context if available
+        if user_context:
+            system_parts.append("ИНФОРМАЦИЯ О ПОЛЬЗОВАТЕЛЕ:")
+            system_parts.append(user_context)
+            system_parts.append("")  # Empty line
+        
+        # Add summary of turns that no longer fit into the history window
+        if history_summary:
+            system_parts.append("КРАТКОЕ СОДЕРЖАНИЕ ПРЕДЫДУЩЕГО РАЗГОВОРА:")
+            system_parts.append(history_summary)
+            system_parts.append("")  # Empty line
+        
+        # Add language instruction
+        if message_language:
             system_parts.append(f"ВАЖНО: Пользователь пишет на языке: {message_language}. Отвечай ОБЯЗАТЕЛЬНО на том же языке, на котором задан вопрос.")
-            
-            if user_context:
-                system_parts.append("\nИспользуй информацию о пользователе для персонализации разговора. Будь естественным и дружелюбным.")
-            else:
-                system_parts.append("\nОбщайся естественно и помогай пользователю.")
-            
-            system_message = "\n".join(system_parts)
-            messages.append({"role": "system", "content": system_message})
-            
-            # Add chat history
+        
+        if user_context:
+            system_parts.append("\nИспользуй информацию о пользователе для персонализации разговора. Будь естественным и дружелюбным.")
+        else:
+            system_parts.append("\nОбщайся естественно и помогай пользователю.")
+        
+        return "\n".join(system_parts)
+    
+    def _build_turn_prompt(
+        self,
+        message: str,
+        message_language: str,
+        search_results: Optional[str] = None,
+        chat_history: Optional[List[Dict[str, str]]] = None,
+        history_summary: Optional[str] = None
+    ) -> str:
+        """Build the per-turn prompt for context-reuse mode (turn instructions + message)"""
+        prompt_parts = []
+        
+        # Seed a cold session with its earlier turns
+        if history_summary:
+            prompt_parts.append("КРАТКОЕ СОДЕРЖАНИЕ ПРЕДЫДУЩЕГО РАЗГОВОРА:")
+            prompt_parts.append(history_summary)
+            prompt_parts.append("")  # Empty line
+        
+        if chat_history:
+            prompt_parts.append("ПРЕДЫДУЩИЙ РАЗГОВОР:")
             for msg in chat_history:
-                messages.append({"role": msg["role"], "content": msg["message"]})
+                speaker = "Пользователь" if msg["role"] == "user" else "Ассистент"
+                prompt_parts.append(f"{speaker}: {msg['message']}")
+            prompt_parts.append("")  # Empty line
+        
+        if search_results:
+            prompt_parts.append(search_results)
+            prompt_parts.append("ВАЖНО: Используй эту актуальную информацию из интернета для ответа на вопрос пользователя.")
+            prompt_parts.append("")  # Empty line
+        
+        prompt_parts.append(f"ВАЖНО: Пользователь пишет на языке: {message_language}. Отвечай ОБЯЗАТЕЛЬНО на том же языке, на котором задан вопрос.")
+        prompt_parts.append("")  # Empty line
+        prompt_parts.append(message)
+        
+        return "\n".join(prompt_parts)
+    
+    async def _build_messages(
+        self,
+        message: str,
+        chat_history: List[Dict[str, str]],
+        user_context: Optional[str] = None,
+        history_summary: Optional[str] = None
+    ) -> List[Dict[str, str]]:
+        """Build the message list (system prompt, history, current message) for Ollama"""
+        # Detect message language
+        message_language = self._detect_language(message)
+        
+        # Check if user explicitly requested web search
+        with stage("search"):
+            search_results = await self._get_search_results(message, message_language)
+        
+        messages = []
+        
+        # Build system message
+        with stage("prompt_build"):
+            ai_rules = await self.ai_rules.get()
+            system_message = self._build_system_prompt(
+                ai_rules["block"], user_context, search_results, message_language, history_summary
+            )
+        messages.append({"role": "system", "content": system_message})
+        
+        # Add chat history
+        for msg in chat_history:
+            messages.append({"role": msg["role"], "content": msg["message"]})
+        
+        # Add current message
+        messages.append({"role": "user", "content": message})
+        
+        return messages
+    
+    async def embed(self, text: str) -> Optional[List[float]]:
+        """Get an embedding of the text from the Ollama embeddings endpoint"""
+        if not settings.OLLAMA_EMBED_MODEL:
+            return None
+        try:
+            async with self.pool.acquire() as backend:
+                response = await backend.client.embeddings(
+                    model=settings.OLLAMA_EMBED_MODEL,
+                    prompt=text
+                )
+            return response.get('embedding') or None
+        except Exception as e:
+            print(f"Error getting embedding: {e}")
+            return None
+    
+    @staticmethod
+    def _without_greeting(chat_history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """History without the assistant messages before the first user message (session greeting)"""
+        for index, msg in enumerate(chat_history):
+            if msg["role"] == "user":
+                return chat_history[index:]
+        return []
+    
+    def _response_cache_scope(
+        self,
+        message: str,
+        normalized: str,
+        user_context: Optional[str],
+        cache_opt_out: bool,
+        conversation: List[Dict[str, str]],
+        history_summary: Optional[str]
+    ) -> Optional[str]:
+        """Cache scope for a message, or None if its answer must not be cached"""
+        if len(normalized) < settings.RESPONSE_CACHE_MIN_CHARS:
+            return None
+        # Web search answers depend on fresh results
+        if self._check_if_search_requested(message)[0]:
+            return None
+        if user_context and (cache_opt_out or conversation or history_summary):
+            # Opted-out users keep personalized answers; a personalized conversation is never shared
+            return None
+        if conversation or history_summary:
+            # A follow-up is answered from the conversation, so the key covers it
+            digest = hashlib.sha256()
+            for msg in conversation:
+                digest.update(f"{msg['role']}\x00{msg['message']}\x00".encode('utf-8'))
+            digest.update((history_summary or '').encode('utf-8'))
+            return f"shared:{digest.hexdigest()}"
+        return "shared"
+    
+    async def _generate(
+        self,
+        message: str,
+        chat_history: List[Dict[str, str]],
+        user_context: Optional[str],
+        user_id: Optional[str],
+        priority: GenerationPriority,
+        session_id: Optional[str],
+        history_summary: Optional[str],
+        cache_opt_out: bool = False
+    ) -> AsyncIterator[str]:
+        """
+        Yield response tokens, answering from the response cache when possible
+        
+        Cached answers are shared between users, so a cacheable turn is
+        answered without the personal context and the session greeting;
+        users who opted out get their personalized answer uncached instead.
+        """
+        if not settings.RESPONSE_CACHE_ENABLED:
+            async for token in self._generate_reply(
+                message, chat_history, user_context, user_id, priority, session_id, history_summary
+            ):
+                yield token
+            return
+        
+        normalized = ResponseCache.normalize(message)
+        conversation = self._without_greeting(chat_history)
+        scope = self._response_cache_scope(
+            message, normalized, user_context, cache_opt_out, conversation, history_summary
+        )
+        if scope is None:
+            self.response_cache.record_bypass()
+            async for token in self._generate_reply(
+                message, chat_history, user_context, user_id, priority, session_id, history_summary
+            ):
+                yield token
+            return
+        
+        # Nothing personal may end up in a shared answer
+        chat_history = conversation
+        user_context = None
+        
+        ai_rules = await self.ai_rules.get()
+        version = f"{self.model}:{ai_rules['fingerprint']}"
+        key = ResponseCache.make_key(normalized, version, scope)
+        with stage("cache_lookup"):
+            cached = self.response_cache.get_exact(key)
+            embedding = None
+            if cached is None:
+                embedding = await self.embed(normalized)
+                if embedding:
+                    cached = self.response_cache.get_similar(embedding, version, scope)
+        
+        if cached is not None:
+            if session_id:
+                # The stored generation context does not contain this turn
+                self.session_contexts.discard(session_id)
+            yield cached
+            return
+        
+        self.response_cache.record_miss()
+        tokens = []
+        async for token in self._generate_reply(
+            message, chat_history, user_context, user_id, priority, session_id, history_summary
+        ):
+            tokens.append(token)
+            yield token
+        
+        answer = "".join(tokens)
+        if answer:
+            self.response_cache.put(key, answer, version, scope, embedding)
+    
+    async def _generate_reply(
+        self,
+        message: str,
+        chat_history: List[Dict[str, str]],
+        user_context: Optional[str],
+        user_id: Optional[str],
+        priority: GenerationPriority,
+        session_id: Optional[str],
+        history_summary: Optional[str]
+    ) -> AsyncIterator[str]:
+        """Yield response tokens, reusing the session's generation context when enabled"""
+        if settings.OLLAMA_CONTEXT_REUSE and session_id:
+            async for token in self._generate_with_context(
+                message, chat_history, user_context, user_id, priority, session_id, history_summary
+            ):
+                yield token
+            return
+        
+        messages = await self._build_messages(message, chat_history, user_context, history_summary)
+        
+        # Hold the generation slot until the whole stream is consumed
+        async with self.scheduler.slot(user_id, priority), self.pool.acquire() as backend:
+            started = time.monotonic()
+            first_token = True
+            stream = await backend.client.chat(
+                model=self.model,
+                messages=messages,
+                stream=True
+            )
             
-            # Add current message
-            messages.append({"role": "user", "content": message})
+            async for chunk in stream:
+                token = chunk.get('message', {}).get('content', '')
+                if token:
+                    if first_token:
+                        record_stage("ollama_ttft", time.monotonic() - started)
+                        first_token = False
+                    yield token
+                if chunk.get('done'):
+                    record_ollama_stats(chunk)
+                    observe_generation(chunk)
             
-            # Get response from Ollama
-            response = ollama.chat(
+            record_stage("ollama_generate", time.monotonic() - started)
+    
+    async def _generate_with_context(
+        self,
+        message: str,
+        chat_history: List[Dict[str, str]],
+        user_context: Optional[str],
+        user_id: Optional[str],
+        priority: GenerationPriority,
+        session_id: str,
+        history_summary: Optional[str]
+    ) -> AsyncIterator[str]:
+        """
+        Generate a reply on top of the session's stored Ollama context
+        
+        Only the new turn is sent and evaluated; the session stays pinned to
+        the backend that holds its KV cache. A session without stored context
+        (new, evicted, or whose system prompt changed) is seeded from its
+        history in a single prompt.
+        """
+        message_language = self._detect_language(message)
+        with stage("search"):
+            search_results = await self._get_search_results(message, message_language)
+        
+        with stage("prompt_build"):
+            ai_rules = await self.ai_rules.get()
+            system_message = self._build_system_prompt(ai_rules["block"], user_context)
+            system_hash = hashlib.sha256(system_message.encode('utf-8')).hexdigest()
+        
+        entry = self.session_contexts.get(session_id, chat_history)
+        if entry and entry["system_hash"] != system_hash:
+            # Rules or user profile changed, the stored context is stale
+            entry = None
+        # Taken out of the store until this turn completes, so a failed or
+        # aborted generation leaves no entry behind
+        self.session_contexts.discard(session_id)
+        
+        prompt = self._build_turn_prompt(
+            message,
+            message_language,
+            search_results,
+            chat_history if entry is None else None,
+            history_summary if entry is None else None
+        )
+        
+        final_chunk = None
+        tokens = []
+        async with self.scheduler.slot(user_id, priority), \
+                self.pool.acquire(preferred=entry["backend"] if entry else None) as backend:
+            started = time.monotonic()
+            first_token = True
+            stream = await backend.client.generate(
                 model=self.model,
-                messages=messages
+                prompt=prompt,
+                system=system_message if entry is None else '',
+                context=entry["context"] if entry else None,
+                stream=True
             )
             
-            return response['message']['content']
+            async for chunk in stream:
+                token = chunk.get('response', '')
+                if token:
+                    if first_token:
+                        record_stage("ollama_ttft", time.monotonic() - started)
+                        first_token = False
+                    tokens.append(token)
+                    yield token
+                if chunk.get('done'):
+                    final_chunk = chunk
+                    record_ollama_stats(chunk)
+                    observe_generation(chunk)
+            
+            record_stage("ollama_generate", time.monotonic() - started)
+        
+        if final_chunk is None or not final_chunk.get('context'):
+            return
+        
+        reused_tokens = len(entry["context"]) if entry else 0
+        prompt_eval_count = final_chunk.get('prompt_eval_count', 0)
+        self.session_contexts.put(session_id, {
+            "context": final_chunk['context'],
+            "backend": backend.host,
+            "system_hash": system_hash,
+            "last_turn": SessionContextStore.turn_fingerprint(message, "".join(tokens)),
+            "turns": (entry["turns"] if entry else 0) + 1,
+            "reused_tokens": (entry["reused_tokens"] if entry else 0) + reused_tokens,
+            "prompt_eval_tokens": (entry["prompt_eval_tokens"] if entry else 0) + prompt_eval_count
+        })
+        self.session_contexts.record_turn(reused_tokens, prompt_eval_count)
+    
+    async def chat(
+        self,
+        message: str,
+        chat_history: List[Dict[str, str]],
+        user_context: Optional[str] = None,
+        user_id: Optional[str] = None,
+        priority: GenerationPriority = GenerationPriority.INTERACTIVE,
+        session_id: Optional[str] = None,
+        history_summary: Optional[str] = None,
+        cache_opt_out: bool = False
+    ) -> str:
+        """Send a message to Ollama and get response"""
+        try:
+            tokens = [
+                token async for token in self._generate(
+                    message, chat_history, user_context, user_id, priority, session_id, history_summary,
+                    cache_opt_out
+                )
+            ]
+            return "".join(tokens)
         
         except Exception as e:
             print(f"Error in Ollama chat: {e}")
             return f"Извините, произошла ошибка при обработке вашего сообщения: {str(e)}"
     
+    async def chat_stream(
+        self,
+        message: str,
+        chat_history: List[Dict[str, str]],
+        user_context: Optional[str] = None,
+        user_id: Optional[str] = None,
+        priority: GenerationPriority = GenerationPriority.INTERACTIVE,
+        session_id: Optional[str] = None,
+        history_summary: Optional[str] = None,
+        cache_opt_out: bool = False
+    ) -> AsyncIterator[str]:
+        """
+        Send a message to Ollama and yield response tokens as they are generated
+        
+        Args:
+            message: User's message
+            chat_history: Previous messages of the session
+            user_context: Personalized user context
+            user_id: User the generation is scheduled for
+            priority: Scheduling priority class
+            session_id: Chat session (enables context reuse when configured)
+            history_summary: Summary of turns older than chat_history
+            cache_opt_out: Keep the user's personalized answers out of the response cache
+        
+        Yields:
+            Response text chunks in generation order
+        """
+        try:
+            async for token in self._generate(
+                message, chat_history, user_context, user_id, priority, session_id, history_summary,
+                cache_opt_out
+            ):
+                yield token
+        
+        except Exception as e:
+            print(f"Error in Ollama chat stream: {e}")
+            yield f"Извините, произошла ошибка при обработке вашего сообщения: {str(e)}"
+    
+    async def summarize_history(
+        self,
+        previous_summary: Optional[str],
+        messages: List[Dict[str, str]],
+        user_id: Optional[str] = None
+    ) -> Optional[str]:
+        """
+        Fold older conversation turns into a rolling summary
+        
+        Args:
+            previous_summary: Current summary of the session (if any)
+            messages: Turns to add to the summary, oldest first
+            user_id: User the generation is scheduled for
+        
+        Returns:
+            Updated summary or None if generation failed
+        """
+        transcript = "\n".join(
+            f"{'Пользователь' if msg['role'] == 'user' else 'Ассистент'}: {msg['message']}"
+            for msg in messages
+        )
+        prompt = f"""Обнови краткое содержание разговора, добавив в него новые сообщения.
+Сохрани важные факты, договорённости и вопросы пользователя. Пиши кратко, не более 10 предложений.
+
+Текущее краткое содержание:
+{previous_summary or "(пусто)"}
+
+Новые сообщения:
+{transcript}
+
+Только текст обновлённого краткого содержания без пояснений:"""
+
+        try:
+            async with self.scheduler.slot(user_id, GenerationPriority.BACKGROUND), self.pool.acquire() as backend:
+                response = await backend.client.chat(
+                    model=self.model,
+                    messages=[
+                        {"role": "system", "content": "Ты кратко и точно пересказываешь разговоры."},
+                        {"role": "user", "content": prompt}
+                    ]
+                )
+            
+            return response['message']['content'].strip() or None
+        
+        except Exception as e:
+            print(f"Error summarizing history: {e}")
+            return None
+    
     def _detect_language(self, text: str) -> str:
         """Detect language of the text (simple heuristic)"""
         # Check for Hebrew characters
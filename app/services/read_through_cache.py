@@ -0,0 +1,79 @@
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class ReadThroughCache:
+    """
+    In-process LRU cache with TTL in front of a loader
+    
+    A miss calls the loader and keeps its result for ttl_seconds (None
+    only with store_none); beyond max_entries the least recently used
+    entries are evicted. A discard while a load is in progress keeps the
+    possibly stale result of that load out of the cache.
+    """
+    
+    def __init__(self, max_entries: int, ttl_seconds: float, store_none: bool = True):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.store_none = store_none
+        self._entries: "OrderedDict[Hashable, Dict[str, Any]]" = OrderedDict()
+        self._loads: Dict[Hashable, object] = {}  # key -> token of the latest load in progress
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "invalidations": 0
+        }
+    
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry["created_at"] <= self.ttl_seconds:
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry["value"]
+        
+        self.stats["misses"] += 1
+        token = object()
+        self._loads[key] = token
+        try:
+            value = await loader()
+            if self._loads.get(key) is token and (value is not None or self.store_none):
+                self._store(key, value)
+            return value
+        finally:
+            if self._loads.get(key) is token:
+                del self._loads[key]
+    
+    def put(self, key: Hashable, value: Any):
+        """Store a value written by this process"""
+        self._loads.pop(key, None)
+        self._store(key, value)
+    
+    def _store(self, key: Hashable, value: Any):
+        self._entries[key] = {"value": value, "created_at": time.monotonic()}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def discard(self, key: Hashable):
+        self._entries.pop(key, None)
+        self._loads.pop(key, None)
+        self.stats["invalidations"] += 1
+    
+    def clear(self):
+        self._entries.clear()
+        self._loads.clear()
+    
+    def values(self):
+        return [entry["value"] for entry in self._entries.values()]
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            "entries": len(self._entries),
+            **self.stats,
+            "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else 0.0
+        }
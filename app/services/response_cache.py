@@ -0,0 +1,123 @@
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional
+import numpy as np
+
+
+class ResponseCache:
+    """
+    In-process cache of LLM answers
+    
+    Lookups first try an exact match on the normalized message, then a
+    nearest-neighbour search over message embeddings. Entries are scoped
+    (shared or per user) and tied to a version string, so a rules or model
+    change never serves an answer produced under the old prompt.
+    """
+    
+    def __init__(self, max_entries: int, ttl_seconds: float, similarity_threshold: float):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.stats = {
+            "exact_hits": 0,
+            "semantic_hits": 0,
+            "misses": 0,
+            "bypassed": 0
+        }
+    
+    @staticmethod
+    def normalize(message: str) -> str:
+        """Normalize a message for matching (case, whitespace, trailing punctuation)"""
+        normalized = re.sub(r"\s+", " ", message.lower()).strip()
+        return normalized.strip(" .,!?;:…")
+    
+    @staticmethod
+    def make_key(normalized: str, version: str, scope: str) -> str:
+        return hashlib.sha256(f"{version}\x00{scope}\x00{normalized}".encode('utf-8')).hexdigest()
+    
+    def get_exact(self, key: str) -> Optional[str]:
+        """Get answer by exact key"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self._expired(entry):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        self.stats["exact_hits"] += 1
+        return entry["answer"]
+    
+    def get_similar(self, embedding: List[float], version: str, scope: str) -> Optional[str]:
+        """Get the answer of the most similar cached message above the similarity threshold"""
+        vector = self._unit(embedding)
+        keys = []
+        vectors = []
+        for key, entry in self._entries.items():
+            if entry["embedding"] is None or entry["version"] != version or entry["scope"] != scope:
+                continue
+            if entry["embedding"].shape != vector.shape or self._expired(entry):
+                continue
+            keys.append(key)
+            vectors.append(entry["embedding"])
+        if not keys:
+            return None
+        
+        # Cosine similarity of unit vectors, one matrix-vector product for all candidates
+        scores = np.stack(vectors) @ vector
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity_threshold:
+            return None
+        
+        best_key = keys[best]
+        self._entries.move_to_end(best_key)
+        self.stats["semantic_hits"] += 1
+        return self._entries[best_key]["answer"]
+    
+    def put(
+        self,
+        key: str,
+        answer: str,
+        version: str,
+        scope: str,
+        embedding: Optional[List[float]] = None
+    ):
+        """Store an answer, evicting the least recently used entries over capacity"""
+        self._entries[key] = {
+            "answer": answer,
+            "version": version,
+            "scope": scope,
+            "embedding": self._unit(embedding) if embedding else None,
+            "created_at": time.monotonic()
+        }
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def record_miss(self):
+        self.stats["misses"] += 1
+    
+    def record_bypass(self):
+        self.stats["bypassed"] += 1
+    
+    def get_stats(self) -> Dict[str, Any]:
+        hits = self.stats["exact_hits"] + self.stats["semantic_hits"]
+        lookups = hits + self.stats["misses"]
+        return {
+            "entries": len(self._entries),
+            **self.stats,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0
+        }
+    
+    def _expired(self, entry: Dict[str, Any]) -> bool:
+        return time.monotonic() - entry["created_at"] > self.ttl_seconds
+    
+    @staticmethod
+    def _unit(vector: List[float]) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        if norm == 0:
+            return array
+        return array / norm
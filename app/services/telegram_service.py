@@ -1,9 +1,18 @@
-from typing import Dict, Any, Optional
+import asyncio
+from typing import Dict, Any, Optional, Tuple
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.services.base import BaseService
 from app.services.database_service import db_service
 from app.services.ollama_service import ollama_service
+from app.services.context_builder import context_builder
+from app.services.history_writer import history_writer
+from app.services.user_context_cache import user_context_cache
+from app.services.telegram_sessions import telegram_session_registry
+from app.services.read_through_cache import ReadThroughCache
+from app.services.timing import StageTimer, current_timer, stage_histograms
 from app.config import get_settings
-from app.database import SessionLocal
+from app.models.user import AUTH_TYPE_TELEGRAM
 
 settings = get_settings()
 
@@ -12,7 +21,9 @@ class TelegramService(BaseService):
     """Service for managing Telegram bot interactions with database and LLM"""
     
     def __init__(self):
-        self.user_sessions: Dict[int, str] = {}  # telegram_id -> session_id mapping
+        # telegram_id -> user_id never changes once set; unknown users are not cached so a
+        # registration in another bot process is seen on the next update
+        self._user_ids = ReadThroughCache(settings.TELEGRAM_USER_CACHE_SIZE, float("inf"), store_none=False)
     
     async def initialize(self) -> bool:
         """Initialize Telegram service"""
@@ -26,21 +37,31 @@ class TelegramService(BaseService):
         """Check if Telegram service is healthy"""
         return True
     
-    async def is_new_user(self, telegram_id: int) -> bool:
-        """Check if user is new (not registered yet)"""
-        db = SessionLocal()
+    async def _find_user_id(self, db: AsyncSession, telegram_id: int) -> Optional[str]:
+        """Resolve telegram_id to user_id through the cache"""
+        return await self._user_ids.get(
+            telegram_id,
+            lambda: db_service.get_user_id_by_telegram_id(db, telegram_id)
+        )
+    
+    async def resolve(self, db: AsyncSession, telegram_id: int) -> "TelegramUpdateContext":
+        """Resolve the user and the active chat session of an update"""
+        user_id = None
+        session_id = None
         try:
-            user = db_service.get_user_by_telegram_id(db, telegram_id)
-            return user is None
+            user_id = await self._find_user_id(db, telegram_id)
+            if user_id:
+                session_id = await telegram_session_registry.get(db, telegram_id)
+            # Return the connection to the pool; handlers may wait (message coalescing) before using it
+            await db.commit()
         except Exception as e:
-            print(f"Error checking if user is new: {e}")
-            return True
-        finally:
-            db.close()
+            print(f"Error resolving telegram user: {e}")
+            await db.rollback()
+        return TelegramUpdateContext(db, telegram_id, user_id, session_id)
     
     async def register_new_user(
         self,
-        telegram_id: int,
+        ctx: "TelegramUpdateContext",
         username: str = None,
         full_name: str = None,
         age: str = None,
@@ -49,28 +70,24 @@ class TelegramService(BaseService):
         bio: str = None
     ) -> Optional[str]:
         """Register new user with personalization data"""
-        db = SessionLocal()
+        db = ctx.db
         try:
             # Create new user
             user_data = {
-                "username": username or f"tg_{telegram_id}",
-                "password": f"telegram_{telegram_id}"  # Auto-generated password
+                "username": username or f"tg_{ctx.telegram_id}",
+                "auth_type": AUTH_TYPE_TELEGRAM,  # Signs in through Telegram only, no password to hash
+                "telegram_id": ctx.telegram_id
             }
             
-            new_user = db_service.create_user(db, user_data)
+            new_user = await db_service.create_user(db, user_data)
             
             if not new_user:
                 return None
+            self._user_ids.put(ctx.telegram_id, new_user.id)
+            ctx.user_id = new_user.id
             
-            # Store telegram_id in personal facts
             from app.schemas import PersonalFactCreate, UserDetailsCreate
             
-            db_service.create_personal_fact(
-                db,
-                new_user.id,
-                PersonalFactCreate(fact_key="telegram_id", fact_value=str(telegram_id))
-            )
-            
             # Create user details with name and bio
             details_data = {}
             if full_name:
@@ -79,7 +96,7 @@ class TelegramService(BaseService):
                 details_data['bio'] = bio
             
             if details_data:
-                db_service.create_user_details(
+                await db_service.create_user_details(
                     db,
                     new_user.id,
                     UserDetailsCreate(**details_data)
@@ -87,193 +104,239 @@ class TelegramService(BaseService):
             
             # Add personal facts
             if age:
-                db_service.create_personal_fact(
+                await db_service.create_personal_fact(
                     db,
                     new_user.id,
                     PersonalFactCreate(fact_key="возраст", fact_value=age)
                 )
             
             if interests:
-                db_service.create_personal_fact(
+                await db_service.create_personal_fact(
                     db,
                     new_user.id,
                     PersonalFactCreate(fact_key="интересы", fact_value=interests)
                 )
             
             if language:
-                db_service.create_personal_fact(
+                await db_service.create_personal_fact(
                     db,
                     new_user.id,
                     PersonalFactCreate(fact_key="предпочитаемый_язык", fact_value=language)
                 )
             
+            await user_context_cache.invalidate(db, new_user.id)
             return new_user.id
-            
+        
         except Exception as e:
             print(f"Error registering new user: {e}")
-            db.rollback()
+            await db.rollback()
             return None
-        finally:
-            db.close()
     
-    async def get_or_create_user(self, telegram_id: int, username: str = None, full_name: str = None) -> Optional[str]:
-        """Get existing user by telegram_id or create new one"""
-        db = SessionLocal()
+    async def get_or_create_user(
+        self,
+        ctx: "TelegramUpdateContext",
+        username: str = None,
+        full_name: str = None
+    ) -> Optional[str]:
+        """Get the user of the update or create one"""
+        if ctx.user_id is not None:
+            return ctx.user_id
+        
+        db = ctx.db
         try:
-            # Try to find user by telegram_id in personal_facts
-            user = db_service.get_user_by_telegram_id(db, telegram_id)
-            
-            if user:
-                return user.id
-            
             # Create new user
             user_data = {
-                "username": username or f"tg_{telegram_id}",
-                "password": f"telegram_{telegram_id}"  # Auto-generated password
+                "username": username or f"tg_{ctx.telegram_id}",
+                "auth_type": AUTH_TYPE_TELEGRAM,  # Signs in through Telegram only, no password to hash
+                "telegram_id": ctx.telegram_id
             }
             
-            new_user = db_service.create_user(db, user_data)
+            try:
+                new_user = await db_service.create_user(db, user_data)
+            except IntegrityError:
+                # Registered concurrently by another update
+                await db.rollback()
+                ctx.user_id = await self._find_user_id(db, ctx.telegram_id)
+                return ctx.user_id
             
             if new_user:
-                # Store telegram_id in personal facts
-                from app.schemas import PersonalFactCreate
-                db_service.create_personal_fact(
-                    db,
-                    new_user.id,
-                    PersonalFactCreate(fact_key="telegram_id", fact_value=str(telegram_id))
-                )
+                self._user_ids.put(ctx.telegram_id, new_user.id)
+                ctx.user_id = new_user.id
                 
                 # Store username and full_name if provided
                 if full_name:
                     from app.schemas import UserDetailsCreate
-                    db_service.create_user_details(
+                    await db_service.create_user_details(
                         db,
                         new_user.id,
                         UserDetailsCreate(full_name=full_name)
                     )
+                    await user_context_cache.invalidate(db, new_user.id)
                 
                 return new_user.id
             
             return None
-            
+        
         except Exception as e:
             print(f"Error getting/creating user: {e}")
+            await db.rollback()
             return None
-        finally:
-            db.close()
     
-    async def start_chat_session(self, telegram_id: int) -> Optional[str]:
+    async def start_chat_session(self, ctx: "TelegramUpdateContext") -> Optional[str]:
         """Start new chat session for telegram user"""
-        db = SessionLocal()
         try:
-            user_id = await self.get_or_create_user(telegram_id)
+            user_id = await self.get_or_create_user(ctx)
             if not user_id:
                 return None
             
             # Create new session
-            session = db_service.create_chat_session(db, user_id)
+            session = await db_service.create_chat_session(ctx.db, user_id)
             if session:
-                self.user_sessions[telegram_id] = session.session_id
+                await telegram_session_registry.set(ctx.db, ctx.telegram_id, session.session_id)
+                ctx.session_id = session.session_id
                 return session.session_id
             
             return None
-            
+        
         except Exception as e:
             print(f"Error starting chat session: {e}")
+            await ctx.db.rollback()
             return None
-        finally:
-            db.close()
     
-    async def get_session_id(self, telegram_id: int) -> Optional[str]:
-        """Get active session ID for telegram user"""
-        return self.user_sessions.get(telegram_id)
-    
-    async def get_greeting(self, telegram_id: int) -> str:
+    async def get_greeting(self, ctx: "TelegramUpdateContext") -> str:
         """Get personalized greeting for user"""
-        db = SessionLocal()
         try:
-            user_id = await self.get_or_create_user(telegram_id)
+            user_id = await self.get_or_create_user(ctx)
             if not user_id:
                 return "Привет! Я твой AI-ассистент. Чем могу помочь?"
             
             # Get user data for personalization
-            user_data = db_service.get_user_with_details(db, user_id)
+            user_data, _ = await ctx.get_user_context()
+            # Return the connection to the pool while the model is generating
+            await ctx.db.commit()
             
             # Generate greeting using LLM
-            greeting = ollama_service.create_greeting_message(user_data)
+            greeting = await ollama_service.create_greeting_message(user_data, user_id=user_id)
             
             return greeting
-            
+        
         except Exception as e:
             print(f"Error generating greeting: {e}")
+            await ctx.db.rollback()
             return "Привет! Я твой AI-ассистент. Чем могу помочь?"
-        finally:
-            db.close()
     
-    async def process_message(self, telegram_id: int, message: str) -> str:
+    async def process_message(self, ctx: "TelegramUpdateContext", message: str) -> str:
         """Process user message and get AI response"""
-        db = SessionLocal()
+        db = ctx.db
+        timer = StageTimer()
+        timer_token = current_timer.set(timer)
         try:
             # Get or create user
-            user_id = await self.get_or_create_user(telegram_id)
+            with timer.stage("db_user"):
+                user_id = await self.get_or_create_user(ctx)
             if not user_id:
                 return "Произошла ошибка при обработке сообщения. Попробуйте /start"
             
             # Get or create session
-            session_id = self.user_sessions.get(telegram_id)
+            session_id = ctx.session_id
             if not session_id:
-                session_id = await self.start_chat_session(telegram_id)
+                with timer.stage("db_session"):
+                    session_id = await self.start_chat_session(ctx)
                 if not session_id:
                     return "Произошла ошибка при создании сессии. Попробуйте /start"
             
-            # Get chat history
-            history = db_service.get_chat_history(db, session_id)
+            # Get chat history within the token budget
+            with timer.stage("db_history"):
+                conversation = await context_builder.build(db, user_id, session_id)
             
             # Get user context for personalization
-            user_data = db_service.get_user_with_details(db, user_id)
-            context = ollama_service.create_personalized_context(user_data)
+            with timer.stage("db_user_context"):
+                user_context, context = await ctx.get_user_context()
+                # Return the connection to the pool while the model is generating
+                await db.commit()
             
             # Get AI response
-            response = await ollama_service.chat(message, history, context)
+            with timer.stage("llm"):
+                try:
+                    response = await ollama_service.chat(
+                        message,
+                        conversation["history"],
+                        context,
+                        user_id=user_id,
+                        session_id=session_id,
+                        history_summary=conversation["summary"],
+                        cache_opt_out=user_context.get("response_cache_opt_out", False)
+                    )
+                except (Exception, asyncio.CancelledError):
+                    await history_writer.save_unanswered(db, user_id, session_id, message)
+                    raise
             
             # Save messages to database
-            db_service.save_chat_message(db, session_id, "user", message)
-            db_service.save_chat_message(db, session_id, "assistant", response)
+            with timer.stage("db_save"):
+                await history_writer.save_turn(db, user_id, session_id, message, response)
             
+            stage_histograms.observe_timer("telegram_message", timer)
             return response
-            
+        
         except Exception as e:
             print(f"Error processing message: {e}")
+            await db.rollback()
             return f"Извините, произошла ошибка: {str(e)}"
         finally:
-            db.close()
+            current_timer.reset(timer_token)
     
-    async def end_session(self, telegram_id: int) -> bool:
+    async def end_session(self, ctx: "TelegramUpdateContext") -> bool:
         """End chat session for telegram user"""
         try:
-            if telegram_id in self.user_sessions:
-                del self.user_sessions[telegram_id]
+            await telegram_session_registry.remove(ctx.db, ctx.telegram_id)
+            ctx.session_id = None
             return True
         except Exception as e:
             print(f"Error ending session: {e}")
+            await ctx.db.rollback()
             return False
     
-    async def get_user_info(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+    async def get_user_info(self, ctx: "TelegramUpdateContext") -> Optional[Dict[str, Any]]:
         """Get user information"""
-        db = SessionLocal()
         try:
-            user_id = await self.get_or_create_user(telegram_id)
+            user_id = await self.get_or_create_user(ctx)
             if not user_id:
                 return None
             
-            user_data = db_service.get_user_with_details(db, user_id)
+            user_data, _ = await ctx.get_user_context()
             return user_data
-            
+        
         except Exception as e:
             print(f"Error getting user info: {e}")
+            await ctx.db.rollback()
             return None
-        finally:
-            db.close()
+
+
+class TelegramUpdateContext:
+    """
+    State of one Telegram update shared by its handler and the service
+    
+    Created by UpdateContextMiddleware with a single database session for
+    the whole update. The user and the chat session are resolved once; the
+    personalization context is loaded on first use and then reused.
+    """
+    
+    def __init__(self, db: AsyncSession, telegram_id: int, user_id: Optional[str], session_id: Optional[str]):
+        self.db = db
+        self.telegram_id = telegram_id
+        self.user_id = user_id
+        self.session_id = session_id
+        self._user_context: Optional[Tuple[Dict[str, Any], str]] = None
+    
+    @property
+    def is_new_user(self) -> bool:
+        return self.user_id is None
+    
+    async def get_user_context(self) -> Tuple[Dict[str, Any], str]:
+        """Personalization context (dict and rendered prompt fragment) of the user"""
+        if self._user_context is None:
+            self._user_context = await user_context_cache.get(self.db, self.user_id)
+        return self._user_context
 
 
 # Singleton instance
@@ -0,0 +1,67 @@
+from typing import Any, Dict, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import get_settings
+from app.services.database_service import db_service
+from app.services.notifications import notification_listener
+from app.services.read_through_cache import ReadThroughCache
+
+settings = get_settings()
+
+CHANGE_CHANNEL = "telegram_session_changed"
+
+
+class TelegramSessionRegistry:
+    """
+    Active chat session of each Telegram user, shared by all bot processes
+    
+    The mapping lives in the telegram_sessions table and is read through
+    an in-process LRU/TTL cache. Every change is announced with a
+    PostgreSQL NOTIFY so the other bot processes drop their cached entry.
+    """
+    
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self._cache = ReadThroughCache(max_entries, ttl_seconds)
+    
+    async def get(self, db: AsyncSession, telegram_id: int) -> Optional[str]:
+        return await self._cache.get(
+            telegram_id,
+            lambda: db_service.get_telegram_session(db, telegram_id)
+        )
+    
+    async def set(self, db: AsyncSession, telegram_id: int, session_id: str):
+        """Make a chat session the active one (commits)"""
+        await db_service.set_telegram_session(db, telegram_id, session_id)
+        await notification_listener.publish(db, CHANGE_CHANNEL, str(telegram_id))
+        await db.commit()
+        self._cache.put(telegram_id, session_id)
+    
+    async def remove(self, db: AsyncSession, telegram_id: int):
+        """End the active session (commits)"""
+        await db_service.delete_telegram_session(db, telegram_id)
+        await notification_listener.publish(db, CHANGE_CHANNEL, str(telegram_id))
+        await db.commit()
+        self._cache.put(telegram_id, None)
+    
+    async def start(self):
+        """Follow session changes made by other bot processes"""
+        await notification_listener.subscribe(CHANGE_CHANNEL, self._on_notification, on_connect=self._cache.clear)
+    
+    def _on_notification(self, telegram_id: str):
+        self._cache.discard(int(telegram_id))
+    
+    def cached_sessions(self) -> int:
+        """Number of active sessions cached by this process"""
+        return sum(1 for session_id in self._cache.values() if session_id)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "listening": notification_listener.connected,
+            **self._cache.get_stats()
+        }
+
+
+# Singleton instance
+telegram_session_registry = TelegramSessionRegistry(
+    settings.TELEGRAM_STATE_CACHE_SIZE,
+    settings.TELEGRAM_STATE_CACHE_TTL_SECONDS
+)
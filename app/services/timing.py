@@ -0,0 +1,132 @@
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Any, Optional, Mapping, Tuple
+
+
+class StageTimer:
+    """Wall-clock durations of the stages of a single request"""
+    
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stages: "OrderedDict[str, float]" = OrderedDict()
+        self.counters: Dict[str, int] = {}
+    
+    @contextmanager
+    def stage(self, name: str):
+        """Time the enclosed block as stage `name`"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - started)
+    
+    def record(self, name: str, seconds: float):
+        """Add a duration to a stage (repeated stages accumulate)"""
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+    
+    def count(self, name: str, value: int):
+        self.counters[name] = self.counters.get(name, 0) + value
+    
+    def total(self) -> float:
+        return time.monotonic() - self.started
+    
+    def server_timing_header(self) -> str:
+        """Render stages as a Server-Timing header value"""
+        entries = []
+        for name, seconds in self.stages.items():
+            entry = f"{name};dur={seconds * 1000:.1f}"
+            if name == "ollama_prompt_eval" and "ollama_prompt_tokens" in self.counters:
+                entry += f';desc="tokens={self.counters["ollama_prompt_tokens"]}"'
+            elif name == "ollama_eval" and "ollama_eval_tokens" in self.counters:
+                entry += f';desc="tokens={self.counters["ollama_eval_tokens"]}"'
+            entries.append(entry)
+        entries.append(f"total;dur={self.total() * 1000:.1f}")
+        return ", ".join(entries)
+
+
+# Timer of the request being handled in the current task
+current_timer: ContextVar[Optional[StageTimer]] = ContextVar("current_timer", default=None)
+
+
+@contextmanager
+def stage(name: str):
+    """Time a stage of the current request (no-op outside a timed request)"""
+    timer = current_timer.get()
+    if timer is None:
+        yield
+        return
+    with timer.stage(name):
+        yield
+
+
+def record_stage(name: str, seconds: float):
+    """Record a measured duration for the current request"""
+    timer = current_timer.get()
+    if timer is not None:
+        timer.record(name, seconds)
+
+
+def record_ollama_stats(chunk: Mapping[str, Any]):
+    """Record Ollama's own timings from the final response chunk (durations are in ns)"""
+    timer = current_timer.get()
+    if timer is None:
+        return
+    for field, name in (
+        ("load_duration", "ollama_load"),
+        ("prompt_eval_duration", "ollama_prompt_eval"),
+        ("eval_duration", "ollama_eval")
+    ):
+        if chunk.get(field):
+            timer.record(name, chunk[field] / 1e9)
+    if chunk.get("prompt_eval_count") is not None:
+        timer.count("ollama_prompt_tokens", chunk["prompt_eval_count"])
+    if chunk.get("eval_count") is not None:
+        timer.count("ollama_eval_tokens", chunk["eval_count"])
+
+
+class StageHistograms:
+    """Aggregated latency histograms per (source, stage)"""
+    
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    
+    def __init__(self):
+        self._histograms: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    
+    def observe(self, source: str, stage_name: str, seconds: float):
+        histogram = self._histograms.get((source, stage_name))
+        if histogram is None:
+            histogram = {"count": 0, "sum": 0.0, "buckets": [0] * (len(self.BUCKETS) + 1)}
+            self._histograms[(source, stage_name)] = histogram
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+        histogram["buckets"][bisect_left(self.BUCKETS, seconds)] += 1
+    
+    def observe_timer(self, source: str, timer: StageTimer):
+        """Add all stages of a finished request"""
+        for stage_name, seconds in timer.stages.items():
+            self.observe(source, stage_name, seconds)
+        self.observe(source, "total", timer.total())
+    
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Cumulative bucket counts per source and stage"""
+        result: Dict[str, Dict[str, Any]] = {}
+        for (source, stage_name), histogram in sorted(self._histograms.items()):
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(self.BUCKETS + (float("inf"),), histogram["buckets"]):
+                cumulative += count
+                buckets["+Inf" if bound == float("inf") else str(bound)] = cumulative
+            result.setdefault(source, {})[stage_name] = {
+                "count": histogram["count"],
+                "sum": round(histogram["sum"], 6),
+                "avg_ms": round(histogram["sum"] / histogram["count"] * 1000, 1),
+                "buckets": buckets
+            }
+        return result
+
+
+# Singleton instance
+stage_histograms = StageHistograms()
@@ -0,0 +1,70 @@
+from typing import Dict, Any, Tuple
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import get_settings
+from app.services.database_service import db_service
+from app.services.ollama_service import ollama_service
+from app.services.notifications import notification_listener
+from app.services.read_through_cache import ReadThroughCache
+
+settings = get_settings()
+
+INVALIDATION_CHANNEL = "user_context_invalidated"
+
+
+class UserContextCache:
+    """
+    Per-user cache of the personalization context
+    
+    Holds the user context dict together with its rendered prompt fragment
+    in a ReadThroughCache (TTL, LRU eviction). Profile writes invalidate
+    the entry locally and through a PostgreSQL NOTIFY, which the other API
+    workers and the bot receive via LISTEN.
+    Cached dicts are shared between callers and must not be modified.
+    """
+    
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self._cache = ReadThroughCache(max_entries, ttl_seconds)
+    
+    async def get(self, db: AsyncSession, user_id: str) -> Tuple[Dict[str, Any], str]:
+        """Get the user context dict and its rendered prompt fragment"""
+        return await self._cache.get(user_id, lambda: self._load(db, user_id))
+    
+    @staticmethod
+    async def _load(db: AsyncSession, user_id: str) -> Tuple[Dict[str, Any], str]:
+        data = await db_service.get_user_context(db, user_id)
+        return data, ollama_service.create_personalized_context(data)
+    
+    def discard(self, user_id: str):
+        """Drop the cached context of a user in this process"""
+        self._cache.discard(user_id)
+    
+    def clear(self):
+        self._cache.clear()
+    
+    async def invalidate(self, db: AsyncSession, user_id: str):
+        """Drop the cached context of a user in every process (call after the change is committed)"""
+        self.discard(user_id)
+        try:
+            await notification_listener.publish(db, INVALIDATION_CHANNEL, user_id)
+            await db.commit()
+        except Exception as e:
+            # Other processes fall back to the TTL
+            print(f"Error publishing user context invalidation: {e}")
+    
+    async def start(self):
+        """Start listening for invalidations from other processes"""
+        # Invalidations sent while the listener was down are lost
+        await notification_listener.subscribe(INVALIDATION_CHANNEL, self.discard, on_connect=self.clear)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "listening": notification_listener.connected,
+            **self._cache.get_stats()
+        }
+
+
+# Singleton instance
+user_context_cache = UserContextCache(
+    settings.USER_CONTEXT_CACHE_SIZE,
+    settings.USER_CONTEXT_CACHE_TTL_SECONDS
+)
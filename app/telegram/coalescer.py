@@ -0,0 +1,120 @@
+import asyncio
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from aiogram.types import Message
+from app.config import get_settings
+
+settings = get_settings()
+
+
+class MessageCoalescer:
+    """
+    Merges bursts of plain text messages of a user into one turn
+    
+    ChatOrderingDispatcher registers every message on arrival, while it is
+    still waiting for its turn. Queues are kept per sender in each chat, so
+    in a group only the messages of one user are merged. When a text
+    reaches the chat handler, `collect` takes the plain texts of the same
+    sender queued right behind it, i.e. the ones that arrived during the
+    previous generation. Only when it took some, so a burst is in
+    progress, it keeps taking new ones until `window_ms` passes without
+    another message; a lone message is answered at once. Absorbed
+    messages are skipped when their turn comes. A command stops the merge,
+    so it is handled after the merged turn, as sent.
+    """
+    
+    def __init__(self, window_ms: int, max_messages: int):
+        self.window = max(0, window_ms) / 1000
+        self.max_messages = max(1, max_messages)
+        self._queues: Dict[Tuple[int, Optional[int]], Deque[Dict[str, Any]]] = {}  # (chat_id, user_id) -> messages waiting for their turn
+        self.stats = {
+            "merged_turns": 0,
+            "absorbed_messages": 0
+        }
+    
+    @staticmethod
+    def _key(message: Message) -> Tuple[int, Optional[int]]:
+        return message.chat.id, message.from_user.id if message.from_user else None
+    
+    @staticmethod
+    def _mergeable(message: Message) -> bool:
+        return bool(message.text) and not message.text.startswith("/")
+    
+    def arrived(self, message: Message):
+        """Register a message before it waits for its turn"""
+        self._queues.setdefault(self._key(message), deque()).append({
+            "message_id": message.message_id,
+            "text": message.text if self._mergeable(message) else None,
+            "absorbed": False
+        })
+    
+    def begin(self, message: Message) -> bool:
+        """Called when the message gets its turn; False if it was merged into an earlier turn"""
+        entry = self._pop(message)
+        return entry is None or not entry["absorbed"]
+    
+    def discard(self, message: Message):
+        """Forget a message that will not be handled"""
+        self._pop(message)
+    
+    def _pop(self, message: Message) -> Optional[Dict[str, Any]]:
+        key = self._key(message)
+        queue = self._queues.get(key)
+        if not queue:
+            return None
+        for entry in queue:
+            if entry["message_id"] == message.message_id:
+                queue.remove(entry)
+                break
+        else:
+            entry = None
+        if not queue:
+            del self._queues[key]
+        return entry
+    
+    def _absorb(self, key: Tuple[int, Optional[int]], limit: int) -> List[str]:
+        texts = []
+        for entry in self._queues.get(key, ()):
+            if len(texts) >= limit:
+                break
+            if entry["absorbed"]:
+                continue
+            if entry["text"] is None:
+                break
+            entry["absorbed"] = True
+            texts.append(entry["text"])
+        return texts
+    
+    def _has_waiting(self, key: Tuple[int, Optional[int]]) -> bool:
+        return any(not entry["absorbed"] for entry in self._queues.get(key, ()))
+    
+    async def collect(self, message: Message) -> str:
+        """Text of the user turn started by a message, with the messages merged into it"""
+        key = self._key(message)
+        texts = [message.text]
+        while True:
+            texts.extend(self._absorb(key, self.max_messages - len(texts)))
+            # Wait only inside a burst; stop at the limit, at a waiting command, or when there is no window
+            if len(texts) == 1 or len(texts) >= self.max_messages or self._has_waiting(key) or not self.window:
+                break
+            await asyncio.sleep(self.window)
+            if not self._has_waiting(key):
+                break
+        
+        if len(texts) > 1:
+            self.stats["merged_turns"] += 1
+            self.stats["absorbed_messages"] += len(texts) - 1
+        return "\n".join(texts)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "waiting_senders": len(self._queues),
+            **self.stats
+        }
+
+
+# Singleton instance
+message_coalescer = MessageCoalescer(
+    settings.TELEGRAM_COALESCE_WINDOW_MS,
+    settings.TELEGRAM_COALESCE_MAX_MESSAGES
+)
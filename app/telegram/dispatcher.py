@@ -0,0 +1,65 @@
+import asyncio
+import time
+from typing import Any, Dict, List, Optional
+from aiogram import Bot, Dispatcher
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.types import Update
+from app.services.metrics import TELEGRAM_QUEUED_UPDATES, TELEGRAM_QUEUE_WAIT
+from app.telegram.coalescer import MessageCoalescer
+
+
+class ChatOrderingDispatcher(Dispatcher):
+    """
+    Handles updates of different chats concurrently and of one chat in order
+    
+    Every chat has its own lock, taken in `feed_update` before any
+    middleware runs (FSMContextMiddleware already awaits the storage), so
+    the updates of a chat are handled one at a time in the order Telegram
+    delivered them (asyncio.Lock wakes its waiters first in, first out).
+    Chats do not wait for each other; at most `workers` updates are handled
+    at once.
+    
+    With a coalescer, messages are registered with it on arrival and the
+    ones it merged into an earlier turn are skipped.
+    """
+    
+    def __init__(self, workers: int, coalescer: Optional[MessageCoalescer] = None, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.workers = max(1, workers)
+        self.coalescer = coalescer
+        self._slots = asyncio.Semaphore(self.workers)
+        self._chats: Dict[int, Dict[str, Any]] = {}  # chat_id -> lock and number of its queued updates
+    
+    async def feed_update(self, bot: Bot, update: Update, **kwargs: Any) -> Any:
+        chat, _, _ = UserContextMiddleware.resolve_event_context(update)
+        if chat is None:
+            async with self._slots:
+                return await super().feed_update(bot, update, **kwargs)
+        
+        # Nothing may await before the chat lock is requested
+        message = update.message if self.coalescer is not None else None
+        if message is not None:
+            self.coalescer.arrived(message)
+        
+        queue = self._chats.setdefault(chat.id, {"lock": asyncio.Lock(), "queued": 0})
+        queue["queued"] += 1
+        TELEGRAM_QUEUED_UPDATES.inc()
+        started = time.monotonic()
+        try:
+            async with queue["lock"], self._slots:
+                TELEGRAM_QUEUE_WAIT.observe(time.monotonic() - started)
+                if message is not None and not self.coalescer.begin(message):
+                    # Already answered as part of an earlier turn
+                    return None
+                return await super().feed_update(bot, update, **kwargs)
+        finally:
+            if message is not None:
+                self.coalescer.discard(message)
+            queue["queued"] -= 1
+            if not queue["queued"]:
+                del self._chats[chat.id]
+            TELEGRAM_QUEUED_UPDATES.dec()
+    
+    def queue_lengths(self) -> List[int]:
+        """Updates queued or in progress per chat, longest first"""
+        return sorted((queue["queued"] for queue in self._chats.values()), reverse=True)
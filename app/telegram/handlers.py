@@ -2,23 +2,22 @@ from aiogram import Router, F
 from aiogram.filters import Command, CommandStart
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from aiogram.fsm.context import FSMContext
-from app.services.telegram_service import telegram_service
+from app.services.telegram_service import telegram_service, TelegramUpdateContext
 from app.telegram.states import RegistrationStates
+from app.telegram.coalescer import message_coalescer
 
 router = Router()
 
 
 @router.message(CommandStart())
-async def cmd_start(message: Message, state: FSMContext):
+async def cmd_start(message: Message, state: FSMContext, update_context: TelegramUpdateContext):
     """Handle /start command"""
     telegram_id = message.from_user.id
     username = message.from_user.username
     full_name = message.from_user.full_name
     
     # Check if user already exists
-    is_new_user = await telegram_service.is_new_user(telegram_id)
-    
-    if is_new_user:
+    if update_context.is_new_user:
         # Start registration process for new user
         await state.update_data(telegram_id=telegram_id, username=username, full_name=full_name)
         
@@ -35,19 +34,17 @@ async def cmd_start(message: Message, state: FSMContext):
         await state.set_state(RegistrationStates.waiting_for_name)
     else:
         # Existing user - just greet
-        await telegram_service.start_chat_session(telegram_id)
-        greeting = await telegram_service.get_greeting(telegram_id)
+        await telegram_service.start_chat_session(update_context)
+        greeting = await telegram_service.get_greeting(update_context)
         await message.answer(greeting)
 
 
 @router.message(Command("newsession"))
-async def cmd_new_session(message: Message):
+async def cmd_new_session(message: Message, update_context: TelegramUpdateContext):
     """Start a new chat session"""
-    telegram_id = message.from_user.id
-    
     # End current session and start new one
-    await telegram_service.end_session(telegram_id)
-    session_id = await telegram_service.start_chat_session(telegram_id)
+    await telegram_service.end_session(update_context)
+    session_id = await telegram_service.start_chat_session(update_context)
     
     if session_id:
         await message.answer("🔄 Начата новая сессия! Предыдущая история сохранена.")
@@ -56,11 +53,9 @@ async def cmd_new_session(message: Message):
 
 
 @router.message(Command("profile"))
-async def cmd_profile(message: Message):
+async def cmd_profile(message: Message, update_context: TelegramUpdateContext):
     """Show user profile"""
-    telegram_id = message.from_user.id
-    
-    user_info = await telegram_service.get_user_info(telegram_id)
+    user_info = await telegram_service.get_user_info(update_context)
     
     if not user_info:
         await message.answer("❌ Не удалось получить информацию о профиле. Попробуйте /start")
@@ -205,7 +200,7 @@ async def process_language(message: Message, state: FSMContext):
 
 
 @router.message(RegistrationStates.waiting_for_bio)
-async def process_bio(message: Message, state: FSMContext):
+async def process_bio(message: Message, state: FSMContext, update_context: TelegramUpdateContext):
     """Process user's bio and complete registration"""
     bio = message.text.strip()
     
@@ -220,7 +215,7 @@ async def process_bio(message: Message, state: FSMContext):
     
     # Register user with all information
     user_id = await telegram_service.register_new_user(
-        telegram_id=data['telegram_id'],
+        update_context,
         username=data['username'],
         full_name=data.get('user_name', data.get('full_name', '')),
         age=data.get('age'),
@@ -231,10 +226,10 @@ async def process_bio(message: Message, state: FSMContext):
     
     if user_id:
         # Start chat session
-        await telegram_service.start_chat_session(data['telegram_id'])
+        await telegram_service.start_chat_session(update_context)
         
         # Get personalized greeting
-        greeting = await telegram_service.get_greeting(data['telegram_id'])
+        greeting = await telegram_service.get_greeting(update_context)
         
         await message.answer(
             "✅ Регистрация завершена!\n\n"
@@ -251,7 +246,7 @@ async def process_bio(message: Message, state: FSMContext):
 
 
 @router.message(F.text)
-async def handle_message(message: Message, state: FSMContext):
+async def handle_message(message: Message, state: FSMContext, update_context: TelegramUpdateContext):
     """Handle regular text messages"""
     # Check if user is in registration process
     current_state = await state.get_state()
@@ -259,15 +254,10 @@ async def handle_message(message: Message, state: FSMContext):
         # User is in registration, don't handle message here
         return
     
-    telegram_id = message.from_user.id
-    user_message = message.text
-    
     # Check if user has active session
-    session_id = await telegram_service.get_session_id(telegram_id)
-    if not session_id:
+    if not update_context.session_id:
         # Check if user exists
-        is_new = await telegram_service.is_new_user(telegram_id)
-        if is_new:
+        if update_context.is_new_user:
             await message.answer(
                 "Привет! Похоже, ты здесь впервые. "
                 "Отправь /start чтобы зарегистрироваться и начать общение! 👋"
@@ -275,18 +265,16 @@ async def handle_message(message: Message, state: FSMContext):
             return
         
         # Auto-start session for existing user
-        await telegram_service.get_or_create_user(
-            telegram_id,
-            message.from_user.username,
-            message.from_user.full_name
-        )
-        await telegram_service.start_chat_session(telegram_id)
+        await telegram_service.start_chat_session(update_context)
+    
+    # Messages sent in quick succession become one turn with one reply
+    user_message = await message_coalescer.collect(message)
     
     # Show typing indicator
     await message.bot.send_chat_action(chat_id=message.chat.id, action="typing")
     
     # Process message and get response
-    response = await telegram_service.process_message(telegram_id, user_message)
+    response = await telegram_service.process_message(update_context, user_message)
     
     # Send response
     await message.answer(response)
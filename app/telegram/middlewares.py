@@ -0,0 +1,55 @@
+import time
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from app.database import AsyncSessionLocal
+from app.services.metrics import TELEGRAM_UPDATES, TELEGRAM_LATENCY
+from app.services.telegram_service import telegram_service
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Counts and times calls of each handler"""
+    
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.monotonic()
+        status = "ok"
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            TELEGRAM_UPDATES.labels(handler=name, status=status).inc()
+            TELEGRAM_LATENCY.labels(handler=name).observe(time.monotonic() - started)
+
+
+class UpdateContextMiddleware(BaseMiddleware):
+    """
+    Resolves the user and the chat session once per update
+    
+    Handlers that take an `update_context` argument get a
+    TelegramUpdateContext backed by one database session, which is closed
+    when the handler returns. Other handlers do not touch the database.
+    """
+    
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        handler_object = data.get("handler")
+        if user is None or "update_context" not in getattr(handler_object, "params", ()):
+            return await handler(event, data)
+        
+        async with AsyncSessionLocal() as db:
+            data["update_context"] = await telegram_service.resolve(db, user.id)
+            return await handler(event, data)
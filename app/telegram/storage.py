@@ -0,0 +1,70 @@
+from typing import Any, Dict, Optional, Tuple
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from app.database import AsyncSessionLocal
+from app.services.database_service import db_service
+from app.services.notifications import notification_listener
+from app.services.read_through_cache import ReadThroughCache
+
+CHANGE_CHANNEL = "telegram_fsm_changed"
+
+
+class PostgresStorage(BaseStorage):
+    """
+    aiogram FSM storage in the telegram_fsm table
+    
+    Lets a registration started in one bot process continue in another
+    and survive restarts. Records are read through an in-process LRU/TTL
+    cache; writes are announced with a PostgreSQL NOTIFY so the other
+    processes drop their cached copy.
+    """
+    
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self._cache = ReadThroughCache(max_entries, ttl_seconds)
+    
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        parts = [key.bot_id, key.chat_id, key.user_id]
+        if key.thread_id is not None:
+            parts.append(key.thread_id)
+        parts.append(key.destiny)
+        return ":".join(str(part) for part in parts)
+    
+    async def _load(self, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        async with AsyncSessionLocal() as db:
+            return await db_service.get_fsm_record(db, key)
+    
+    async def _get_record(self, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        return await self._cache.get(key, lambda: self._load(key))
+    
+    async def _write(self, key: str, column: str, value: Any):
+        async with AsyncSessionLocal() as db:
+            await db_service.set_fsm_value(db, key, column, value)
+            await notification_listener.publish(db, CHANGE_CHANNEL, key)
+            await db.commit()
+        self._cache.discard(key)
+    
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._write(self._key(key), "state", state.state if isinstance(state, State) else state)
+    
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._get_record(self._key(key))
+        return state
+    
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._write(self._key(key), "data", dict(data) or None)
+    
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._get_record(self._key(key))
+        # Cached records are shared
+        return dict(data)
+    
+    async def start(self):
+        """Follow FSM changes made by other bot processes"""
+        await notification_listener.subscribe(CHANGE_CHANNEL, self._cache.discard, on_connect=self._cache.clear)
+    
+    async def close(self) -> None:
+        pass
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return self._cache.get_stats()
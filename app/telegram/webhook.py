@@ -0,0 +1,81 @@
+import asyncio
+import signal
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from app.config import get_settings
+
+settings = get_settings()
+
+
+class WebhookRequestHandler(SimpleRequestHandler):
+    """
+    Feeds webhook updates to the dispatcher
+    
+    Telegram gets its response immediately and the update is handled in
+    the background. On shutdown the updates still in progress are given
+    TELEGRAM_WEBHOOK_SHUTDOWN_TIMEOUT seconds to finish.
+    """
+    
+    async def close(self):
+        tasks = set(self._background_feed_update_tasks)
+        if tasks:
+            print(f"Waiting for {len(tasks)} update(s) in progress...")
+            done, pending = await asyncio.wait(tasks, timeout=settings.TELEGRAM_WEBHOOK_SHUTDOWN_TIMEOUT)
+            for task in pending:
+                task.cancel()
+        # The bot session is closed by the entry point
+    
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "status": "ok",
+            "updates_in_progress": len(self._background_feed_update_tasks)
+        })
+
+
+def create_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    """Create the aiohttp application that receives updates"""
+    app = web.Application()
+    handler = WebhookRequestHandler(
+        dp,
+        bot,
+        secret_token=settings.TELEGRAM_WEBHOOK_SECRET or None
+    )
+    handler.register(app, path=settings.TELEGRAM_WEBHOOK_PATH)
+    app.router.add_get("/health", handler.handle_health)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """Serve the webhook until SIGINT/SIGTERM"""
+    runner = web.AppRunner(create_app(dp, bot))
+    await runner.setup()
+    site = web.TCPSite(runner, settings.TELEGRAM_WEBHOOK_HOST, settings.TELEGRAM_WEBHOOK_PORT)
+    await site.start()
+    print(f"✓ Webhook listening on {settings.TELEGRAM_WEBHOOK_HOST}:{settings.TELEGRAM_WEBHOOK_PORT}{settings.TELEGRAM_WEBHOOK_PATH}")
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    try:
+        if settings.TELEGRAM_WEBHOOK_URL:
+            # Only after the server is up, so Telegram's first delivery succeeds
+            await bot.set_webhook(
+                settings.telegram_webhook_url,
+                secret_token=settings.TELEGRAM_WEBHOOK_SECRET or None,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+            print(f"✓ Webhook registered: {settings.telegram_webhook_url}")
+        else:
+            print("⚠️  TELEGRAM_WEBHOOK_URL is not set, webhook is not registered with Telegram")
+        
+        await stop.wait()
+        print("\n\n🛑 Stopping bot...")
+    finally:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+        # Stops accepting requests, then waits for the updates in progress
+        await runner.cleanup()
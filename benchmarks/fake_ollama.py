@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Stand-in Ollama server for benchmarks
+Streams canned tokens at a configurable speed, so the bot can be load-tested
+without a GPU or network access
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+from datetime import datetime
+from aiohttp import web
+
+REPLY = (
+    "Это тестовый ответ локального сервера, который имитирует Ollama. "
+    "Он возвращает фиксированный текст с заданной скоростью генерации, "
+    "чтобы можно было измерить накладные расходы самого приложения."
+)
+
+
+class FakeOllama:
+    """
+    Minimal implementation of the Ollama API used by the bot
+    
+    Supports /api/tags, /api/chat, /api/generate and /api/embeddings.
+    Generation waits `ttft` seconds before the first token and then emits
+    `tokens_per_second` tokens; `failure_rate` of requests fail with HTTP 500.
+    """
+    
+    def __init__(
+        self,
+        model: str = "llama3:8b",
+        tokens_per_second: float = 50.0,
+        ttft: float = 0.2,
+        failure_rate: float = 0.0,
+        reply_tokens: int = 40,
+        embedding_size: int = 64
+    ):
+        self.model = model
+        self.tokens_per_second = tokens_per_second
+        self.ttft = ttft
+        self.failure_rate = failure_rate
+        self.reply_tokens = reply_tokens
+        self.embedding_size = embedding_size
+        self.stats = {"requests": 0, "failures": 0, "generated_tokens": 0}
+        self._runner = None
+    
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/api/tags", self.tags)
+        app.router.add_post("/api/chat", self.chat)
+        app.router.add_post("/api/generate", self.generate)
+        app.router.add_post("/api/embeddings", self.embeddings)
+        return app
+    
+    async def start(self, host: str = "127.0.0.1", port: int = 11435):
+        """Start serving in the running event loop"""
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+    
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+    
+    async def tags(self, request: web.Request) -> web.Response:
+        return web.json_response({"models": [{"name": self.model, "model": self.model, "size": 0}]})
+    
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        prompt = "".join(m.get("content", "") for m in body.get("messages", []))
+        return await self._respond(request, body, prompt, chat=True)
+    
+    async def generate(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        prompt = body.get("system", "") + body.get("prompt", "")
+        return await self._respond(request, body, prompt, chat=False)
+    
+    async def embeddings(self, request: web.Request) -> web.Response:
+        self.stats["requests"] += 1
+        body = await request.json()
+        # Deterministic pseudo-embedding, so identical prompts get identical vectors
+        seed = hashlib.sha256(body.get("prompt", "").encode("utf-8")).digest()
+        rng = random.Random(seed)
+        return web.json_response({"embedding": [rng.uniform(-1, 1) for _ in range(self.embedding_size)]})
+    
+    async def _respond(self, request: web.Request, body: dict, prompt: str, chat: bool) -> web.StreamResponse:
+        self.stats["requests"] += 1
+        if self.failure_rate and random.random() < self.failure_rate:
+            self.stats["failures"] += 1
+            return web.json_response({"error": "simulated failure"}, status=500)
+        
+        started = time.monotonic()
+        prompt_tokens = max(1, len(prompt) // 3)
+        tokens = [word + " " for word in REPLY.split()]
+        tokens = (tokens * (self.reply_tokens // len(tokens) + 1))[:self.reply_tokens]
+        
+        await asyncio.sleep(self.ttft)
+        prompt_eval_duration = time.monotonic() - started
+        
+        stream = body.get("stream", True)
+        response = None
+        if stream:
+            response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+            await response.prepare(request)
+        
+        delay = 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+        eval_started = time.monotonic()
+        for i, token in enumerate(tokens):
+            if i and delay:
+                await asyncio.sleep(delay)
+            if stream:
+                await response.write((json.dumps(self._chunk(token, chat, done=False)) + "\n").encode("utf-8"))
+        eval_duration = time.monotonic() - eval_started
+        self.stats["generated_tokens"] += len(tokens)
+        
+        final = self._chunk("" if stream else "".join(tokens), chat, done=True)
+        final.update({
+            "total_duration": int((time.monotonic() - started) * 1e9),
+            "load_duration": 0,
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(prompt_eval_duration * 1e9),
+            "eval_count": len(tokens),
+            "eval_duration": int(eval_duration * 1e9)
+        })
+        if not chat:
+            final["context"] = list(body.get("context") or []) + list(range(prompt_tokens + len(tokens)))
+        
+        if not stream:
+            return web.json_response(final)
+        await response.write((json.dumps(final) + "\n").encode("utf-8"))
+        await response.write_eof()
+        return response
+    
+    def _chunk(self, text: str, chat: bool, done: bool) -> dict:
+        chunk = {
+            "model": self.model,
+            "created_at": datetime.utcnow().isoformat() + "Z",
+            "done": done
+        }
+        if chat:
+            chunk["message"] = {"role": "assistant", "content": text}
+        else:
+            chunk["response"] = text
+        return chunk
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Options of the fake server (shared with the benchmark runner)"""
+    parser.add_argument("--model", default="llama3:8b", help="Model name reported by /api/tags")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="Generation speed (0 = instant)")
+    parser.add_argument("--ttft", type=float, default=0.2, help="Time to first token, seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of generations failing with HTTP 500")
+    parser.add_argument("--reply-tokens", type=int, default=40, help="Tokens per reply")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    add_arguments(parser)
+    args = parser.parse_args()
+    
+    server = FakeOllama(
+        model=args.model,
+        tokens_per_second=args.tokens_per_second,
+        ttft=args.ttft,
+        failure_rate=args.failure_rate,
+        reply_tokens=args.reply_tokens
+    )
+    await server.start(args.host, args.port)
+    print(f"✓ Fake Ollama listening on http://{args.host}:{args.port} (model {args.model})")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("\n👋 Goodbye!")
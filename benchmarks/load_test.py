@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+End-to-end load benchmark
+Runs the FastAPI app against a local Postgres and a fake Ollama server and
+drives login -> chat start -> messages -> history for concurrent users
+
+Usage:
+    python -m benchmarks.load_test --users 20 --concurrency 10 --turns 5
+    python -m benchmarks.load_test --output before.json
+    python -m benchmarks.load_test --baseline before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Any, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import uvicorn
+from sqlalchemy import event
+
+from benchmarks.fake_ollama import FakeOllama, add_arguments
+
+PHASES = ["login", "chat_start", "chat_message", "chat_history"]
+
+
+class QueryCounter:
+    """Counts SQL statements executed by an engine"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+    
+    def attach(self, engine):
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+    
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        with self._lock:
+            self.count += 1
+
+
+class PhaseStats:
+    """Latencies and errors of one phase"""
+    
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.queries = 0
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+    
+    def add(self, seconds: float, ok: bool):
+        if ok:
+            self.latencies.append(seconds)
+        else:
+            self.errors += 1
+    
+    def summary(self) -> Dict[str, Any]:
+        latencies = sorted(self.latencies)
+        requests = len(latencies) + self.errors
+        duration = (self.finished or 0) - (self.started or 0)
+        return {
+            "requests": requests,
+            "errors": self.errors,
+            "throughput_rps": round(requests / duration, 2) if duration > 0 else 0.0,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "queries_per_request": round(self.queries / requests, 2) if requests else 0.0
+        }
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Nearest-rank percentile in milliseconds"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values))) - 1))
+    return round(sorted_values[rank] * 1000, 1)
+
+
+def run_in_thread(coroutine_factory) -> threading.Thread:
+    """Run a coroutine on its own event loop in a daemon thread"""
+    thread = threading.Thread(target=lambda: asyncio.run(coroutine_factory()), daemon=True)
+    thread.start()
+    return thread
+
+
+async def wait_for(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+class LoadTest:
+    """Drives the API with concurrent virtual users"""
+    
+    def __init__(self, base_url: str, args: argparse.Namespace, counter: QueryCounter):
+        self.base_url = base_url
+        self.args = args
+        self.counter = counter
+        self.phases = {name: PhaseStats() for name in PHASES}
+        self.tokens: Dict[str, str] = {}
+        self.sessions: Dict[str, str] = {}
+    
+    def usernames(self) -> List[str]:
+        return [f"{self.args.user_prefix}_{i}" for i in range(self.args.users)]
+    
+    async def setup_users(self, client: httpx.AsyncClient):
+        """Register benchmark users (existing ones are reused)"""
+        for username in self.usernames():
+            response = await client.post("/auth/register", json={
+                "username": username,
+                "password": self.args.password
+            })
+            if response.status_code not in (201, 400):
+                raise RuntimeError(f"Cannot register {username}: {response.status_code} {response.text}")
+    
+    async def run_phase(self, name: str, client: httpx.AsyncClient, step):
+        """Run `step(client, username)` for every user with the configured concurrency"""
+        stats = self.phases[name]
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        
+        async def worker(username: str):
+            async with semaphore:
+                await step(client, username, stats)
+        
+        queries_before = self.counter.count
+        stats.started = time.monotonic()
+        await asyncio.gather(*(worker(username) for username in self.usernames()))
+        stats.finished = time.monotonic()
+        stats.queries = self.counter.count - queries_before
+    
+    async def timed(self, stats: PhaseStats, request) -> Optional[httpx.Response]:
+        started = time.monotonic()
+        try:
+            response = await request
+        except httpx.HTTPError:
+            stats.add(time.monotonic() - started, ok=False)
+            return None
+        stats.add(time.monotonic() - started, ok=response.status_code < 400)
+        return response if response.status_code < 400 else None
+    
+    def auth(self, username: str) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.tokens[username]}"}
+    
+    async def login(self, client: httpx.AsyncClient, username: str, stats: PhaseStats):
+        response = await self.timed(stats, client.post("/auth/login", json={
+            "username": username,
+            "password": self.args.password
+        }))
+        if response is not None:
+            self.tokens[username] = response.json()["access_token"]
+    
+    async def chat_start(self, client: httpx.AsyncClient, username: str, stats: PhaseStats):
+        if username not in self.tokens:
+            return
+        response = await self.timed(stats, client.post("/chat/start", headers=self.auth(username)))
+        if response is not None:
+            self.sessions[username] = response.json()["session_id"]
+    
+    async def chat_message(self, client: httpx.AsyncClient, username: str, stats: PhaseStats):
+        if username not in self.sessions:
+            return
+        path = "/chat/message/stream" if self.args.stream else "/chat/message"
+        for turn in range(self.args.turns):
+            await self.timed(stats, client.post(
+                path,
+                params={"session_id": self.sessions[username]},
+                json={"message": f"Вопрос номер {turn + 1}: расскажи что-нибудь интересное"},
+                headers=self.auth(username)
+            ))
+    
+    async def chat_history(self, client: httpx.AsyncClient, username: str, stats: PhaseStats):
+        if username not in self.sessions:
+            return
+        await self.timed(stats, client.get(
+            f"/chat/history/{self.sessions[username]}",
+            headers=self.auth(username)
+        ))
+    
+    async def run(self) -> Dict[str, Any]:
+        timeout = httpx.Timeout(self.args.timeout)
+        limits = httpx.Limits(max_connections=self.args.concurrency, max_keepalive_connections=self.args.concurrency)
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=timeout, limits=limits) as client:
+            await self.setup_users(client)
+            started = time.monotonic()
+            await self.run_phase("login", client, self.login)
+            await self.run_phase("chat_start", client, self.chat_start)
+            await self.run_phase("chat_message", client, self.chat_message)
+            await self.run_phase("chat_history", client, self.chat_history)
+            duration = time.monotonic() - started
+        
+        message_stats = self.phases["chat_message"]
+        turns = len(message_stats.latencies) + message_stats.errors
+        return {
+            "config": {
+                "users": self.args.users,
+                "concurrency": self.args.concurrency,
+                "turns": self.args.turns,
+                "stream": self.args.stream,
+                "tokens_per_second": self.args.tokens_per_second,
+                "ttft": self.args.ttft,
+                "failure_rate": self.args.failure_rate,
+                "reply_tokens": self.args.reply_tokens
+            },
+            "duration_s": round(duration, 2),
+            "turns_per_second": round(turns / (message_stats.finished - message_stats.started), 2)
+            if turns else 0.0,
+            "db_queries_per_turn": round(message_stats.queries / turns, 2) if turns else 0.0,
+            "phases": {name: stats.summary() for name, stats in self.phases.items()}
+        }
+
+
+def print_report(result: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    print("\n" + "=" * 78)
+    print(f"{'phase':<14}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}{'queries':>9}")
+    print("-" * 78)
+    for name, stats in result["phases"].items():
+        print(f"{name:<14}{stats['requests']:>9}{stats['errors']:>8}{stats['throughput_rps']:>9}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}"
+              f"{stats['queries_per_request']:>9}")
+    print("-" * 78)
+    print(f"Turns/s: {result['turns_per_second']}   DB queries per turn: {result['db_queries_per_turn']}   "
+          f"Duration: {result['duration_s']}s")
+    if "fake_ollama" in result:
+        fake = result["fake_ollama"]
+        print(f"Fake Ollama: {fake['requests']} requests, {fake['failures']} simulated failures, "
+              f"{fake['generated_tokens']} tokens")
+    
+    if baseline:
+        print("\nChange against baseline:")
+        for name, stats in result["phases"].items():
+            before = baseline.get("phases", {}).get(name)
+            if not before:
+                continue
+            changes = []
+            for key in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms", "queries_per_request"):
+                if before[key]:
+                    changes.append(f"{key} {(stats[key] - before[key]) / before[key] * 100:+.1f}%")
+            print(f"  {name:<14}" + ", ".join(changes))
+    print("=" * 78)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="End-to-end load benchmark with a fake Ollama server")
+    parser.add_argument("--users", type=int, default=20, help="Virtual users")
+    parser.add_argument("--concurrency", type=int, default=10, help="Users active at the same time")
+    parser.add_argument("--turns", type=int, default=5, help="Messages sent by each user")
+    parser.add_argument("--stream", action="store_true", help="Use /chat/message/stream")
+    parser.add_argument("--user-prefix", default="bench_user")
+    parser.add_argument("--password", default="bench_password")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Request timeout, seconds")
+    parser.add_argument("--app-port", type=int, default=8765)
+    parser.add_argument("--ollama-port", type=int, default=11435)
+    parser.add_argument("--output", help="Write results as JSON")
+    parser.add_argument("--baseline", help="Compare with a previous JSON result")
+    add_arguments(parser)
+    args = parser.parse_args()
+    
+    # Point the app at the fake server before its settings are loaded
+    os.environ["OLLAMA_BASE_URL"] = f"http://127.0.0.1:{args.ollama_port}"
+    os.environ["OLLAMA_BASE_URLS"] = ""
+    os.environ["OLLAMA_MODEL"] = args.model
+    os.environ["GOOGLE_SEARCH_ENABLED"] = "false"
+    
+    from app.database import engine, async_engine
+    from app.main import app
+    
+    counter = QueryCounter()
+    counter.attach(engine)
+    counter.attach(async_engine.sync_engine)
+    
+    fake = FakeOllama(
+        model=args.model,
+        tokens_per_second=args.tokens_per_second,
+        ttft=args.ttft,
+        failure_rate=args.failure_rate,
+        reply_tokens=args.reply_tokens
+    )
+    
+    async def serve_fake():
+        await fake.start("127.0.0.1", args.ollama_port)
+        await asyncio.Event().wait()
+    
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=args.app_port, log_level="warning"))
+    
+    # The app, the fake Ollama and the load generator each get their own event loop
+    run_in_thread(serve_fake)
+    await wait_for(f"http://127.0.0.1:{args.ollama_port}/api/tags")
+    run_in_thread(server.serve)
+    await wait_for(f"http://127.0.0.1:{args.app_port}/health")
+    
+    print(f"Running: {args.users} users, concurrency {args.concurrency}, {args.turns} turns, "
+          f"{args.tokens_per_second} tokens/s, TTFT {args.ttft}s, failure rate {args.failure_rate}")
+    result = await LoadTest(f"http://127.0.0.1:{args.app_port}", args, counter).run()
+    result["fake_ollama"] = dict(fake.stats)
+    server.should_exit = True
+    
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"✓ Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
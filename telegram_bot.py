@@ -5,16 +5,27 @@ Run this script to start the Telegram bot
 """
 import asyncio
 import sys
-from aiogram import Bot, Dispatcher
+from aiogram import Bot
 from aiogram.enums import ParseMode
+from prometheus_client import start_http_server
 
 # Add project root to path
 sys.path.insert(0, '/home/dmitrylil/workspace/LTS-AAI/chat-bot')
 
 from app.config import get_settings
 from app.telegram.handlers import router
+from app.telegram.dispatcher import ChatOrderingDispatcher
+from app.telegram.middlewares import MetricsMiddleware, UpdateContextMiddleware
+from app.telegram.storage import PostgresStorage
+from app.telegram.coalescer import message_coalescer
+from app.telegram.webhook import run_webhook
 from app.database import init_db
 from app.services.ollama_service import ollama_service
+from app.services.telegram_sessions import telegram_session_registry
+from app.services.history_writer import history_writer
+from app.services.user_context_cache import user_context_cache
+from app.services.notifications import notification_listener
+from app.services.metrics import TELEGRAM_ACTIVE_SESSIONS
 
 settings = get_settings()
 
@@ -25,6 +36,12 @@ async def main():
     print("🤖 Starting Telegram Bot")
     print("=" * 50)
     
+    # A public webhook without a secret would accept forged updates from anyone
+    if settings.TELEGRAM_WEBHOOK_ENABLED and settings.TELEGRAM_WEBHOOK_URL and not settings.TELEGRAM_WEBHOOK_SECRET:
+        print("\n❌ TELEGRAM_WEBHOOK_SECRET is not set!")
+        print("Set it to a long random string to use a public webhook (TELEGRAM_WEBHOOK_URL).")
+        return
+    
     # Initialize database
     print("\n📦 Initializing database...")
     init_db()
@@ -49,18 +66,42 @@ async def main():
     print(f"\n🚀 Starting bot with token: {settings.TELEGRAM_BOT_TOKEN[:10]}...")
     bot = Bot(token=settings.TELEGRAM_BOT_TOKEN, parse_mode=ParseMode.HTML)
     
-    dp = Dispatcher()
+    # Follow profile and AI rules changes made through the API
+    await user_context_cache.start()
+    await ollama_service.ai_rules.start()
+    
+    # Sessions and registration progress are shared by all bot processes
+    storage = PostgresStorage(settings.TELEGRAM_STATE_CACHE_SIZE, settings.TELEGRAM_STATE_CACHE_TTL_SECONDS)
+    await storage.start()
+    await telegram_session_registry.start()
+    
+    dp = ChatOrderingDispatcher(settings.TELEGRAM_WORKERS, message_coalescer, storage=storage)
+    router.message.middleware(MetricsMiddleware())
+    router.message.middleware(UpdateContextMiddleware())
     dp.include_router(router)
     
-    # Start polling
+    # Expose Prometheus metrics
+    if settings.TELEGRAM_METRICS_PORT:
+        TELEGRAM_ACTIVE_SESSIONS.set_function(telegram_session_registry.cached_sessions)
+        start_http_server(settings.TELEGRAM_METRICS_PORT)
+        print(f"✓ Metrics available on port {settings.TELEGRAM_METRICS_PORT}")
+    
     print("\n✓ Bot is running! Press Ctrl+C to stop.")
     print("=" * 50)
     
     try:
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        if settings.TELEGRAM_WEBHOOK_ENABLED:
+            await run_webhook(dp, bot)
+        else:
+            # Polling does not work while a webhook is registered
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     except KeyboardInterrupt:
         print("\n\n🛑 Stopping bot...")
     finally:
+        await history_writer.stop()
+        await ollama_service.ai_rules.stop()
+        await notification_listener.stop()
         await bot.session.close()
         print("✓ Bot stopped successfully!")
 